@@ -0,0 +1,281 @@
+# Benchmarks for the learning platform.
+#
+#   python benchmark.py reruns [--iterations 30]
+#   python benchmark.py load [--users 8] [--latency 0.2] [--error-rate 0] [--shapes valid]
+#
+# "reruns" compares the cost of a full script rerun of each interactive view with
+# rerunning only the fragment that holds its buttons (day navigator, test
+# question view, flashcard viewer). Before the views were fragments, every click
+# re-executed the whole script; now a click only reruns the fragment.
+#
+# "load" runs N simulated users concurrently, each in its own AppTest session:
+# log in, generate a course, step through days, create and answer a test,
+# generate review flashcards, grade them and log out. It reports throughput and
+# tail latency per step. Both run against the offline FakeLLMBackend.
+
+import argparse
+import contextlib
+import math
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+from unittest.mock import MagicMock
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "streamlit_app.py")
+BENCH_USER = "bench"
+BENCH_LANGUAGE = "Python"
+
+# Keep benchmark state away from the real database and caches, and never call Gemini
+os.environ.setdefault("STORAGE_PATH", os.path.join(tempfile.mkdtemp(prefix="bench-"), "bench.db"))
+os.environ.setdefault("EXPLANATION_CACHE_DIR", os.path.join(tempfile.mkdtemp(prefix="bench-"), "cache"))
+os.environ["PREFETCH_AHEAD_DAYS"] = "0"
+os.environ["LLM_BACKEND"] = "fake"
+sys.path.insert(0, APP_DIR)
+
+from streamlit import config
+from streamlit.runtime import Runtime
+from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+from streamlit.runtime.media_file_manager import MediaFileManager
+from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, app_test, local_script_runner
+
+import streamlit_app as app
+
+# AppTest compiles the script on every run, while a Streamlit server compiles it
+# once; share one bytecode cache so timings measure execution, not compilation
+SCRIPT_CACHE = ScriptCache()
+local_script_runner.ScriptCache = lambda: SCRIPT_CACHE
+
+# AppTest installs a fresh mock Runtime singleton (and patches a config option)
+# around every run and resets it afterwards, so sessions running at the same
+# time pull the runtime out from under each other. For the load test, install one
+# shared runtime for the whole process and point AppTest's swaps at a stand-in.
+def share_test_runtime():
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime._instance = runtime
+    app_test.Runtime = types.SimpleNamespace(_instance=None)
+    config.set_option("global.appTest", True)
+    app_test.patch_config_options = lambda options: contextlib.nullcontext()
+
+# Session state of a logged-in user; views are selected through the sidebar radio
+def logged_in_state():
+    return {
+        "user_authenticated": True,
+        "username": BENCH_USER,
+        "current_course": BENCH_LANGUAGE,
+        "current_test": (BENCH_LANGUAGE, 1),
+        "current_question": 0,
+        "current_flashcards": BENCH_LANGUAGE,
+        "gemini_api_key": None,
+    }
+
+def seed_storage():
+    storage = app.SQLiteStorage(os.environ["STORAGE_PATH"])
+    storage.save_course(BENCH_USER, BENCH_LANGUAGE, {
+        "study_plan": [f"Topic {day}" for day in range(1, 366)],
+        "start_date": "2024-01-01",
+        "current_day": 1,
+        "max_day": 365,
+        "level": "Beginner",
+    })
+    question = {"question": "What is 1 + 1?", "options": ["1", "2", "3", "4"], "correct": "B", "explanation": "Arithmetic"}
+    storage.save_test(BENCH_USER, BENCH_LANGUAGE, {"number": 1, "questions": [question] * 10, "user_answers": {}, "score": 0})
+    storage.add_flashcards(BENCH_USER, BENCH_LANGUAGE, [{"front": f"Card {i}", "back": "Answer"} for i in range(50)])
+
+# Scripts that execute only a fragment, standing in for a fragment-scoped rerun
+def day_navigator_script():
+    import streamlit_app
+    streamlit_app.course_day_navigator("Python")
+
+def test_question_script():
+    import streamlit_app
+    streamlit_app.test_question_view("Python", 1)
+
+def flashcard_viewer_script():
+    import streamlit_app
+    streamlit_app.flashcard_viewer("Python")
+
+VIEWS = [
+    ("course day navigator", "Coding Courses", day_navigator_script),
+    ("test question view", "Tests", test_question_script),
+    ("flashcard viewer", "Flashcards", flashcard_viewer_script),
+]
+
+def time_runs(at, iterations):
+    at.run()  # warm up
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        at.run()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+def full_app(menu):
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    for key, value in logged_in_state().items():
+        at.session_state[key] = value
+    at.run()
+    at.sidebar.radio[0].set_value(menu)
+    return at
+
+def fragment_only(script):
+    at = AppTest.from_function(script, default_timeout=60)
+    for key, value in logged_in_state().items():
+        at.session_state[key] = value
+    # Mirror what initialize_session_state loads at login
+    storage = app.get_storage()
+    at.session_state["conversations"] = {language: app.CourseState(**summary)
+                                         for language, summary in storage.load_course_summaries(BENCH_USER).items()}
+    at.session_state["tests"] = {language: [app.TestSummary(test["number"], test["score"]) for test in tests]
+                                 for language, tests in storage.load_test_summaries(BENCH_USER).items()}
+    at.session_state["flashcards"] = {BENCH_LANGUAGE: None}
+    at.session_state["due_queues"] = {}
+    at.session_state["mastery"] = {}
+    return at
+
+def bench_reruns(iterations):
+    seed_storage()
+    print(f"{'view':<24}{'full rerun ms':>16}{'fragment ms':>14}{'saving':>9}")
+    for name, menu, script in VIEWS:
+        full = statistics.median(time_runs(full_app(menu), iterations))
+        fragment = statistics.median(time_runs(fragment_only(script), iterations))
+        print(f"{name:<24}{full:>16.2f}{fragment:>14.2f}{1 - fragment / full:>9.0%}")
+
+# Nearest-rank percentile, as on the admin page
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+# Collects (step, seconds, error) from all simulated users
+class StepRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}  # step -> list of seconds
+        self.errors = {}  # step -> list of messages
+
+    @staticmethod
+    def failure(at):
+        if at.exception:
+            return at.exception[0].message
+        if at.error:
+            return at.error[0].value
+        return None
+
+    # Run action(), which reruns the app, and record how long it took and whether it failed
+    def step(self, name, at, action, check_errors=True):
+        started = time.perf_counter()
+        try:
+            action()
+            error = self.failure(at) if check_errors else (at.exception[0].message if at.exception else None)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.timings.setdefault(name, []).append(elapsed)
+            if error:
+                self.errors.setdefault(name, []).append(error)
+        return error is None
+
+def simulate_user(username, recorder, days, reviews):
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+
+    def login():
+        at.run()
+        at.text_input(key="login_username").input(username)
+        at.text_input(key="login_password").input(username)
+        at.button(key="login_button").click().run()
+    if not recorder.step("login", at, login):
+        return
+    at.session_state["gemini_api_key"] = f"key-{username}"
+
+    def create_course():
+        at.sidebar.radio[0].set_value("Coding Courses").run()
+        at.button(key="new_course_button").click().run()
+        at.number_input(key="new_course_duration").set_value(days)
+        at.button(key="generate_course_button").click().run()
+    if not recorder.step("create_course", at, create_course):
+        return
+    language = at.session_state["current_course"]
+    for _ in range(3):
+        recorder.step("next_day", at, lambda: at.button(key="next_day_button").click().run())
+
+    def create_test():
+        at.sidebar.radio[0].set_value("Tests").run()
+        at.sidebar.button(key=f"new_test_{language}").click().run()
+    if not recorder.step("create_test", at, create_test):
+        return
+    while [button for button in at.button if button.key == "submit_answer"]:
+        # st.error is the feedback for a wrong answer here, not a failure
+        if not recorder.step("answer", at, lambda: at.button(key="submit_answer").click().run(), check_errors=False):
+            return
+
+    if [button for button in at.button if button.key == "generate_flashcards"]:
+        recorder.step("review_flashcards", at, lambda: at.button(key="generate_flashcards").click().run())
+    at.sidebar.radio[0].set_value("Flashcards").run()
+    if [button for button in at.sidebar.button if button.key == f"flashcards_{language}"]:
+        at.sidebar.button(key=f"flashcards_{language}").click().run()
+    for _ in range(reviews):
+        if not [button for button in at.button if button.key == "reveal_answer"]:
+            break
+        recorder.step("reveal_card", at, lambda: at.button(key="reveal_answer").click().run())
+        recorder.step("grade_card", at, lambda: at.button(key="grade_4").click().run())
+
+    recorder.step("logout", at, lambda: at.sidebar.button(key="logout").click().run())
+
+def bench_load(users, latency, error_rate, shapes, days, reviews):
+    # Read by the app script when it builds its LLM backend on the first run
+    os.environ["FAKE_LLM_LATENCY"] = str(latency)
+    os.environ["FAKE_LLM_ERROR_RATE"] = str(error_rate)
+    os.environ["FAKE_LLM_SHAPES"] = shapes
+    share_test_runtime()
+    usernames = [f"load-{index}" for index in range(users)]
+    for username in usernames:
+        app.register_user(username, username)
+
+    recorder = StepRecorder()
+    threads = [threading.Thread(target=simulate_user, args=(username, recorder, days, reviews)) for username in usernames]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"{users} users in {elapsed:.1f}s (fake LLM latency {latency}s, error rate {error_rate}, shapes {shapes})")
+    print(f"{'step':<20}{'count':>7}{'errors':>8}{'ops/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, timings in recorder.timings.items():
+        errors = len(recorder.errors.get(step, []))
+        print(f"{step:<20}{len(timings):>7}{errors:>8}{len(timings) / elapsed:>8.2f}"
+              f"{percentile(timings, 0.5) * 1000:>10.1f}{percentile(timings, 0.95) * 1000:>10.1f}"
+              f"{percentile(timings, 0.99) * 1000:>10.1f}")
+    for step, errors in recorder.errors.items():
+        print(f"{step}: {errors[0]}" + (f" (and {len(errors) - 1} more)" if len(errors) > 1 else ""))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the learning platform")
+    commands = parser.add_subparsers(dest="command", required=True)
+    reruns = commands.add_parser("reruns", help="compare full-script and fragment rerun cost")
+    reruns.add_argument("--iterations", type=int, default=30)
+    load = commands.add_parser("load", help="run simulated users concurrently and report per-step latency")
+    load.add_argument("--users", type=int, default=8)
+    load.add_argument("--latency", type=float, default=0.2, help="mean fake LLM latency in seconds")
+    load.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake LLM calls that fail")
+    load.add_argument("--shapes", default="valid", help='fake LLM output shapes, e.g. "valid=0.8,truncated=0.1,slow=0.1"')
+    load.add_argument("--days", type=int, default=90, help="course length")
+    load.add_argument("--reviews", type=int, default=5, help="flashcards graded per user")
+    args = parser.parse_args()
+    if args.command == "reruns":
+        bench_reruns(args.iterations)
+    elif args.command == "load":
+        bench_load(args.users, args.latency, args.error_rate, args.shapes, args.days, args.reviews)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# Provision courses for a whole cohort from the command line, without the UI.
+#
+#   python provision_cohort.py cohort.csv --api-key KEY [--workers 4]
+#       [--explanations DAYS] [--question-bank DAYS] [--checkpoint FILE]
+#
+# cohort.csv has a header row and the columns user, language, days and level,
+# plus an optional password column: users without an account get one with that
+# password. Students who share a (language, days, level) share one generated
+# study plan. Courses are written straight into storage, so they are there when
+# the students log in; a course the student already has is left untouched.
+# --explanations and --question-bank pre-generate the explanations and bank
+# questions for the first DAYS days of every plan.
+#
+# Every finished task is appended to the checkpoint file (cohort.csv.checkpoint
+# by default), including the generated study plans. Running the same command
+# again after an interruption or failures only does the remaining work.
+#
+# Run it with the same environment as the app (STORAGE_PATH,
+# EXPLANATION_CACHE_DIR, LLM_BACKEND, ...) so it writes where the app reads.
+
+import argparse
+import csv
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, APP_DIR)
+
+import streamlit_app as app
+
+COHORT_COLUMNS = ("user", "language", "days", "level")
+
+def read_cohort(path):
+    rows = []
+    with open(path, newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        missing = [column for column in COHORT_COLUMNS if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"{path}: missing column(s) {', '.join(missing)}")
+        for line, row in enumerate(reader, start=2):
+            user, language, level = row["user"].strip(), row["language"].strip(), row["level"].strip()
+            try:
+                days = int(row["days"])
+            except ValueError:
+                raise ValueError(f"{path}:{line}: days must be a whole number") from None
+            if not user:
+                raise ValueError(f"{path}:{line}: user is empty")
+            if language not in app.COURSE_LANGUAGES:
+                raise ValueError(f"{path}:{line}: unknown language {language!r}")
+            if level not in app.COURSE_LEVELS:
+                raise ValueError(f"{path}:{line}: level must be one of {', '.join(app.COURSE_LEVELS)}")
+            if not app.COURSE_MIN_DAYS <= days <= app.COURSE_MAX_DAYS:
+                raise ValueError(f"{path}:{line}: days must be between {app.COURSE_MIN_DAYS} and {app.COURSE_MAX_DAYS}")
+            rows.append({"user": user, "language": language, "days": days, "level": level,
+                         "password": (row.get("password") or "").strip()})
+    return rows
+
+# Finished tasks, appended as JSON lines so an interrupted run resumes where it
+# stopped. Tasks are tuples such as ("plan", language, days, level).
+class Checkpoint:
+    def __init__(self, path):
+        self.path = path
+        self.done = {}  # task -> result
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn last line of an interrupted run; the task is redone
+                    self.done[tuple(record["task"])] = record["result"]
+
+    def __contains__(self, task):
+        return task in self.done
+
+    def result(self, task):
+        return self.done[task]
+
+    def record(self, task, result):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"task": task, "result": result}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.done[task] = result
+
+# Run {task: fn} on the pool, skipping tasks that are already checkpointed;
+# returns the number of failed tasks
+def run_tasks(executor, checkpoint, tasks):
+    started = time.perf_counter()
+    futures = {executor.submit(fn): task for task, fn in tasks.items() if task not in checkpoint}
+    failed = 0
+    for future in as_completed(futures):
+        task = futures[future]
+        name = " ".join(str(part) for part in task)
+        try:
+            checkpoint.record(task, future.result())
+            print(f"done    {name}")
+        except Exception as e:
+            failed += 1
+            print(f"failed  {name}: {e}")
+    if futures:
+        print(f"{len(futures) - failed}/{len(futures)} tasks in {time.perf_counter() - started:.1f}s "
+              f"({len(tasks) - len(futures)} already done)")
+    return failed
+
+def create_account(storage, user, password):
+    if storage.load_user(user) is not None or app.register_user(user, password):
+        return "ok"
+    raise ValueError("could not create the account")
+
+def save_course(storage, row, study_plan):
+    if row["language"] in storage.load_course_summaries(row["user"]):
+        return "existing"
+    storage.save_course(row["user"], row["language"], app.new_course_data(study_plan, row["days"], row["level"]))
+    return "created"
+
+def explain(topic, language, level, api_key):
+    app.explain_topic(topic, language, api_key, level, app.PRIORITY_BATCH)
+    return "ok"
+
+def provision(rows, api_key, checkpoint, workers, explanation_days, bank_days):
+    storage = app.get_storage()
+    plan_task = lambda row: ("plan", row["language"], row["days"], row["level"])
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="provision") as executor:
+        print("Accounts")
+        failed += run_tasks(executor, checkpoint, {
+            ("account", row["user"]): functools.partial(create_account, storage, row["user"], row["password"])
+            for row in rows if row["password"]})
+
+        print("Study plans")
+        failed += run_tasks(executor, checkpoint, {
+            plan_task(row): functools.partial(app.generate_study_plan, row["language"], row["days"], row["level"], api_key)
+            for row in rows})
+        plans = {plan_task(row): checkpoint.result(plan_task(row)) for row in rows if plan_task(row) in checkpoint}
+
+        print("Courses")
+        failed += run_tasks(executor, checkpoint, {
+            ("course", row["user"], row["language"]): functools.partial(save_course, storage, row, plans[plan_task(row)])
+            for row in rows if plan_task(row) in plans})
+
+        # Explanations and bank questions depend only on language, level and topic
+        content = {}
+        for (_, language, _, level), study_plan in plans.items():
+            for topic in study_plan[:explanation_days]:
+                content[("explanation", language, level, topic)] = functools.partial(explain, topic, language, level, api_key)
+            for topic in study_plan[:bank_days]:
+                content[("bank", language, level, topic)] = functools.partial(
+                    app.fill_question_bank, language, level, [topic], api_key)
+        if content:
+            print("Explanations and question bank")
+            failed += run_tasks(executor, checkpoint, content)
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="Provision courses for a cohort of students")
+    parser.add_argument("cohort", help="CSV file with user, language, days, level and optional password columns")
+    parser.add_argument("--api-key", default=os.environ.get("GEMINI_API_KEY"), help="Gemini API key (default $GEMINI_API_KEY)")
+    parser.add_argument("--workers", type=int, default=4, help="tasks run at once")
+    parser.add_argument("--explanations", type=int, default=0, metavar="DAYS",
+                        help="pre-generate explanations for the first DAYS days of each plan")
+    parser.add_argument("--question-bank", type=int, default=0, metavar="DAYS",
+                        help="fill the question bank for the first DAYS days of each plan")
+    parser.add_argument("--checkpoint", help="checkpoint file (default COHORT.checkpoint)")
+    args = parser.parse_args()
+    if not args.api_key and app.LLM_BACKEND != "fake":
+        parser.error("an API key is required (--api-key or GEMINI_API_KEY)")
+
+    try:
+        rows = read_cohort(args.cohort)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    checkpoint = Checkpoint(args.checkpoint or f"{args.cohort}.checkpoint")
+    failed = provision(rows, args.api_key or "offline", checkpoint, args.workers, args.explanations, args.question_bank)
+    if failed:
+        print(f"{failed} task(s) failed; run the same command again to retry them")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,141 @@
 import streamlit as st
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
 import json
 import os
 import datetime
 import time
 import random
 import re
+import hashlib
+import hmac
+import threading
+import uuid
+import math
+import functools
+import sys
+import heapq
+import itertools
+import asyncio
+import sqlite3
+import contextlib
+import textwrap
+from array import array
+import numpy as np
+import atexit
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from google.api_core import exceptions as google_exceptions
+from streamlit.errors import StreamlitAPIException
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # Configure page layout
 st.set_page_config(layout="wide", page_title="Personalized Learning Platform")
 
+GEMINI_MODEL_NAME = 'gemini-pro'
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "gemini")  # "fake" runs offline against FakeLLMBackend
+# FakeLLMBackend behaviour
+FAKE_LLM_LATENCY = float(os.environ.get("FAKE_LLM_LATENCY", "0.2"))  # mean seconds per call
+FAKE_LLM_ERROR_RATE = float(os.environ.get("FAKE_LLM_ERROR_RATE", "0"))  # fraction of calls that fail
+FAKE_LLM_SHAPES = os.environ.get("FAKE_LLM_SHAPES", "valid")  # e.g. "valid=0.7,malformed=0.1,truncated=0.1,slow=0.1"
+FAKE_LLM_SEED = os.environ.get("FAKE_LLM_SEED", "0")
+EXPLANATION_CACHE_DIR = os.environ.get("EXPLANATION_CACHE_DIR", ".explanation_cache")
+PLAN_CHUNK_DAYS = 60  # days requested per study plan call
+PLAN_MAX_CALLS = 12  # hard cap on Gemini calls for one study plan, including re-requests
+# Per call type: estimated prompt tokens allowed, max output tokens, output tokens
+# per requested item (for item lists, caps the output at what the items need) and
+# temperature. Explanations come in a short "summary" tier, shown by default and
+# prefetched, and a "deep" tier loaded on request.
+GENERATION_BUDGETS = {
+    "study_plan": {"prompt_tokens": 250, "output_tokens": 1200, "tokens_per_item": 16, "temperature": 0.3},
+    "explanation_summary": {"prompt_tokens": 200, "output_tokens": 600, "temperature": 0.4},
+    "explanation_deep": {"prompt_tokens": 250, "output_tokens": 2500, "temperature": 0.4},
+    "test_questions": {"prompt_tokens": 250, "output_tokens": 2048, "tokens_per_item": 150, "temperature": 0.7},
+    "flashcards": {"prompt_tokens": 200, "output_tokens": 1024, "tokens_per_item": 80, "temperature": 0.5},
+}
+EXPLANATION_TIERS = ("summary", "deep")
+PROMPT_VALUE_MAX_TOKENS = 25  # longest topic, language or level inserted into a prompt
+GEMINI_RATE_LIMIT_PER_MINUTE = int(os.environ.get("GEMINI_RATE_LIMIT_PER_MINUTE", "60"))  # per API key
+GEMINI_RATE_LIMIT_BURST = 10
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "8"))  # process-wide
+# Request priorities, lowest value runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_PREFETCH = 2
+# How failed Gemini attempts are retried, by error kind (see classify_llm_error):
+# whether to retry at all and the base of the exponential backoff in seconds.
+# Each delay is drawn uniformly from zero up to the backoff ("full jitter").
+GEMINI_RETRY_POLICIES = {
+    "transient": {"retry": True, "backoff": 1.0},
+    "timeout": {"retry": True, "backoff": 0.5},
+    "quota": {"retry": True, "backoff": 5.0},  # also pauses the API key's token bucket
+    "safety": {"retry": False},
+    "invalid": {"retry": False},
+}
+GEMINI_BACKOFF_MAX = 30  # seconds
+GEMINI_ATTEMPT_TIMEOUT = float(os.environ.get("GEMINI_ATTEMPT_TIMEOUT", "40"))  # seconds per attempt
+GEMINI_STREAM_TIMEOUT = float(os.environ.get("GEMINI_STREAM_TIMEOUT", "60"))  # seconds per streamed attempt, first chunk to last
+GEMINI_DEADLINES = {PRIORITY_INTERACTIVE: 60, PRIORITY_BATCH: 300, PRIORITY_PREFETCH: 180}  # seconds from submission to failure
+CIRCUIT_BREAKER_FAILURES = 5  # consecutive failed attempts that open an API key's circuit
+CIRCUIT_BREAKER_COOLDOWN = 30  # seconds an open circuit rejects requests before letting one probe through
+CIRCUIT_BREAKER_KINDS = ("transient", "timeout", "quota")  # error kinds that count as failures of the key
+# Hedged requests send a second attempt when the first runs longer than this
+# quantile of recent successful attempts of the same operation
+GEMINI_HEDGE_QUANTILE = 0.95
+GEMINI_HEDGE_MIN_SAMPLES = 20  # attempts observed before the quantile is trusted
+GEMINI_HEDGE_DEFAULT_DELAY = 3.0  # seconds, until then
+STUDY_PLAN_PAGE_DAYS = 30  # study plan days kept in session state per course
+COURSE_LANGUAGES = ["Python", "JavaScript", "Java", "C++", "C#", "Ruby", "Go", "Swift", "Kotlin", "PHP", "R", "TypeScript",
+                    "Scala", "Perl", "Rust", "Dart", "Haskell", "MATLAB"]
+COURSE_LEVELS = ["Beginner", "Intermediate", "Advanced"]
+COURSE_MIN_DAYS = 30
+COURSE_MAX_DAYS = 365
+TEST_QUESTION_COUNT = 10
+FLASHCARD_COUNT = 5
+GENERATION_MAX_ROUNDS = 3  # requests per topic when regenerating a shortfall
+QUESTION_BANK_MIN_PER_TOPIC = 8  # banked questions a topic needs before tests are sampled without generating
+MASTERY_REVIEW_THRESHOLD = 0.6  # earlier topics answered less accurately than this come back in new tests
+MASTERY_REVIEW_TOPICS = 2  # weak earlier topics added to a test
+# SM-2 spaced repetition for flashcards
+FLASHCARD_INITIAL_EASE = 2.5
+FLASHCARD_MIN_EASE = 1.3
+FLASHCARD_RELEARN_SECONDS = 600  # a forgotten card comes back after this long
+FLASHCARD_DUE_WINDOW = 200  # earliest-due cards whose schedules a review session holds
+FINGERPRINT_INDEX_MAX_PER_SCOPE = 10_000  # texts indexed per deck or question bank level
+FINGERPRINT_INDEX_MAX_ENTRIES = 30_000  # texts indexed across all scopes in this process, about 1 KB each
+NEAR_DUPLICATE_THRESHOLD = 0.75  # estimated Jaccard similarity of shingles that counts as a duplicate card
+QUESTION_NEAR_DUPLICATE_THRESHOLD = 0.9  # the same for a question with its options, within one topic
+SHINGLE_SIZE = 4  # characters per shingle
+MINHASH_BINS = 32
+MINHASH_BANDS = 8  # LSH bands of MINHASH_BINS // MINHASH_BANDS bins each
+# Topic similarity: differently phrased study plan topics share explanations and banked questions
+TOPIC_VECTOR_SIZE = 256  # hashed n-gram features per topic vector
+TOPIC_NGRAM_SIZE = 3  # characters per n-gram, taken within words
+TOPIC_SIMILARITY_THRESHOLD = 0.8  # cosine similarity at which two topics count as the same
+TOPIC_SIMILARITY_CANDIDATES = 3  # most similar topics tried per lookup
+TOPIC_WORD_MATCH = 0.5  # n-gram Jaccard similarity at which two words count as forms of one word ("file", "files")
+TOPIC_INDEX_MAX_PER_SCOPE = 5_000  # topics indexed per language and level
+TOPIC_INDEX_MAX_ENTRIES = 40_000  # topics indexed across all scopes in this process, 1 KB each
+TOPIC_STOPWORDS = frozenset("a an and the of in on to for with using via vs versus into from by your its introduction "
+                            "intro basics basic fundamentals overview understanding working".split())
+FLASHCARD_GRADES = [("Again", 1), ("Hard", 3), ("Good", 4), ("Easy", 5)]  # button label, SM-2 quality
+PREFETCH_AHEAD_DAYS = int(os.environ.get("PREFETCH_AHEAD_DAYS", "2"))  # 0 disables prefetching
+PREFETCH_WORKERS = 4
+PREFETCH_PER_KEY_LIMIT = 2  # concurrent prefetch requests per API key
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+STORAGE_PATH = os.environ.get("STORAGE_PATH", "learning_platform.db")
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", "2"))  # seconds between flushes of buffered writes
+WRITE_BEHIND_MAX_PENDING = 500  # flush early once this many keys are dirty
+DEFAULT_USER = "user"
+DEFAULT_PASSWORD = "pass"  # seeded on first start so the demo credentials keep working
+ADMIN_USERS = {user.strip() for user in os.environ.get("ADMIN_USERS", "").split(",") if user.strip()}  # no admins unless configured
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))  # serve /metrics and /metrics.jsonl on localhost; 0 disables
+METRICS_SAMPLE_SIZE = 1024  # recent observations kept per histogram for percentiles
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # seconds
+SIZE_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)  # characters
+ATTEMPT_BUCKETS = (1, 2, 3, 4, 5)
+
 # Initialize session state
 def initialize_session_state():
     if 'user_authenticated' not in st.session_state:
@@ -20,106 +146,2761 @@ def initialize_session_state():
         st.session_state.tests = {}
     if 'flashcards' not in st.session_state:
         st.session_state.flashcards = {}
+    if 'due_queues' not in st.session_state:
+        st.session_state.due_queues = {}
+    if 'mastery' not in st.session_state:
+        st.session_state.mastery = {}
     if 'gemini_api_key' not in st.session_state:
         st.session_state.gemini_api_key = None
     if 'user_points' not in st.session_state:
         st.session_state.user_points = 0
     if 'current_course' not in st.session_state:
         st.session_state.current_course = None
+    if st.session_state.user_authenticated and st.session_state.get('loaded_user') != current_user():
+        load_user_state()
+
+def hash_password(password, salt):
+    return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 200_000).hex()
 
-initialize_session_state()
+# Create an account; returns False if the username is taken
+def register_user(username, password):
+    salt = os.urandom(16)
+    return get_storage().create_user(username, hash_password(password, salt), salt.hex())
 
 # Function to authenticate user
 def authenticate(username, password):
-    return username == "user" and password == "pass"
+    storage = get_storage()
+    if not storage.has_users():
+        register_user(DEFAULT_USER, DEFAULT_PASSWORD)
+    record = storage.load_user(username)
+    if record is None:
+        return False
+    return hmac.compare_digest(hash_password(password, bytes.fromhex(record["salt"])), record["password_hash"])
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # cumulative, as in Prometheus
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=METRICS_SAMPLE_SIZE)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    # Nearest-rank percentile of the recent samples
+    def percentile(self, q):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+# In-process metrics shared by all sessions: counters and histograms keyed by
+# name and labels. Exported as Prometheus text or JSON lines, and summarized on
+# the admin page.
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> Histogram
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def inc(self, name, amount=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    # Percentile of a histogram's recent samples, or None with fewer than min_samples
+    def percentile(self, name, q, min_samples=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None or len(histogram.samples) < min_samples:
+                return None
+            return histogram.percentile(q)
+
+    # Time a block in seconds; outcome is "error" if it raised an exception
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            yield
+        except Exception:
+            outcome = "error"
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - started, outcome=outcome, **labels)
+
+    def counter_rows(self):
+        with self._lock:
+            return [{"metric": name, **dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._counters.items())]
+
+    def histogram_rows(self, suffix=""):
+        with self._lock:
+            items = [(key, histogram) for key, histogram in sorted(self._histograms.items()) if key[0].endswith(suffix)]
+            return [{"metric": name, **dict(labels), "count": histogram.count,
+                     "mean": histogram.sum / histogram.count, "p50": histogram.percentile(0.5),
+                     "p95": histogram.percentile(0.95), "p99": histogram.percentile(0.99)}
+                    for (name, labels), histogram in items]
+
+    @staticmethod
+    def _labels_text(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+        return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+            typed = set()
+            for (name, labels), value in counters:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{self._labels_text(labels)} {value}")
+            for (name, labels), histogram in histograms:
+                if name not in typed:
+                    typed.add(name)
+                    lines.append(f"# TYPE {name} histogram")
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    lines.append(f"{name}_bucket{self._labels_text(labels, [('le', str(bound))])} {count}")
+                lines.append(f"{name}_bucket{self._labels_text(labels, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"{name}_sum{self._labels_text(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{self._labels_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    # One JSON object per series
+    def json_lines(self):
+        now = time.time()
+        records = [{"time": now, "type": "counter", **row} for row in self.counter_rows()]
+        records += [{"time": now, "type": "histogram", **row} for row in self.histogram_rows()]
+        return "".join(json.dumps(record) + "\n" for record in records)
+
+# Serve /metrics (Prometheus text) and /metrics.jsonl from a background thread
+def start_metrics_server(metrics, port):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = metrics.prometheus_text(), "text/plain; version=0.0.4"
+            elif self.path == "/metrics.jsonl":
+                body, content_type = metrics.json_lines(), "application/x-ndjson"
+            else:
+                self.send_error(404)
+                return
+            data = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+@st.cache_resource
+def get_metrics():
+    metrics = Metrics()
+    if METRICS_PORT:
+        try:
+            start_metrics_server(metrics, METRICS_PORT)
+        except OSError:
+            pass  # another app process already serves the port
+    return metrics
+
+# Record the wrapped function's duration as operation_seconds{operation=...}
+def timed(operation):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with get_metrics().timer("operation_seconds", operation=operation):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Record a fragment's render time as fragment_render_seconds{fragment=...}. Goes
+# below @st.fragment so that fragment-only reruns are timed as well.
+def timed_fragment(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with get_metrics().timer("fragment_render_seconds", fragment=fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+# Per-API-key registry of Gemini models, shared by every session in the process.
+# Each key gets its own generative client instead of going through the global
+# genai.configure(), so concurrent sessions using different keys cannot race
+# on the process-wide configuration, and connections are reused across calls.
+class GeminiClientPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._models = {}
+
+    def get_model(self, api_key, model_name=GEMINI_MODEL_NAME):
+        with self._lock:
+            model = self._models.get((api_key, model_name))
+            if model is None:
+                client = self._clients.get(api_key)
+                if client is None:
+                    client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+                    self._clients[api_key] = client
+                model = genai.GenerativeModel(model_name)
+                model._client = client
+                self._models[(api_key, model_name)] = model
+            return model
+
+# A failed LLM call whose kind is already known: one of the GEMINI_RETRY_POLICIES
+# kinds, or "circuit_open" when the API key's circuit breaker rejected the call
+class LLMError(ValueError):
+    def __init__(self, message, kind):
+        super().__init__(message)
+        self.kind = kind
+
+# Kind of a failed LLM call, which decides whether and how it is retried. Read
+# through the kind attribute rather than isinstance(LLMError), since errors
+# raised by shared objects may come from an earlier run of the script.
+def classify_llm_error(error):
+    kind = getattr(error, "kind", None)
+    if kind:
+        return kind
+    if isinstance(error, google_exceptions.TooManyRequests):
+        return "quota"
+    if isinstance(error, (genai.types.BlockedPromptException, genai.types.StopCandidateException)):
+        return "safety"
+    if isinstance(error, (google_exceptions.DeadlineExceeded, TimeoutError)):
+        return "timeout"
+    if isinstance(error, (google_exceptions.InvalidArgument, google_exceptions.PermissionDenied,
+                          google_exceptions.Unauthenticated, google_exceptions.NotFound)):
+        return "invalid"
+    return "transient"
+
+# Why Gemini blocked a response or stream chunk, or None if it didn't
+def blocked_reason(response):
+    feedback = getattr(response, "prompt_feedback", None)
+    if feedback is not None and feedback.block_reason:
+        return getattr(feedback.block_reason, "name", str(feedback.block_reason))
+    for candidate in getattr(response, "candidates", None) or []:
+        reason = getattr(candidate.finish_reason, "name", "")
+        if reason in ("SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII"):
+            return reason
+    return None
+
+# Interface for the text generation service behind query_gemini_api. generate()
+# returns the full response text and raises ValueError when there is none;
+# stream() yields text chunks. generation_config is a dict such as
+# {"max_output_tokens": 600, "temperature": 0.4}, or None for the defaults. A
+# call that runs longer than timeout seconds, for a stream from the request to
+# its last chunk, fails with a "timeout" error. model_name is part of cache and coalescing keys, so responses from different
+# backends never mix.
+class LLMBackend:
+    model_name = None
+
+    def generate(self, prompt, api_key, generation_config=None, timeout=None):
+        raise NotImplementedError
+
+    def stream(self, prompt, api_key, generation_config=None, timeout=None):
+        raise NotImplementedError
+
+class GeminiBackend(LLMBackend):
+    model_name = GEMINI_MODEL_NAME
+
+    def __init__(self):
+        self.pool = GeminiClientPool()
+
+    def generate(self, prompt, api_key, generation_config=None, timeout=None):
+        response = self.pool.get_model(api_key).generate_content(
+            prompt, generation_config=generation_config, request_options={"timeout": timeout} if timeout is not None else None)
+        reason = blocked_reason(response)
+        if reason:
+            raise LLMError(f"The Gemini API blocked the response ({reason})", "safety")
+        text = chunk_text(response) if response else ""
+        if text:
+            return text
+        raise LLMError("No valid response from the Gemini API", "transient")
+
+    def stream(self, prompt, api_key, generation_config=None, timeout=None):
+        for chunk in self.pool.get_model(api_key).generate_content(
+                prompt, stream=True, generation_config=generation_config,
+                request_options={"timeout": timeout} if timeout is not None else None):
+            reason = blocked_reason(chunk)
+            if reason:
+                raise LLMError(f"The Gemini API blocked the response ({reason})", "safety")
+            yield chunk_text(chunk)
+
+FAKE_LLM_WORDS = """variable loop function closure iterator generator list tuple dictionary set class object method
+module package import exception stack heap pointer reference value type string integer float boolean index slice
+range recursion decorator context thread process lock queue coroutine socket file path buffer stream parser token
+syntax scope namespace lambda mapping filter sort search tree graph node edge hash cache memory compiler interpreter
+bytecode assertion fixture interface template pattern callback promise channel vector matrix""".split()
+FAKE_LLM_SHAPE_NAMES = ("valid", "malformed", "truncated", "continue", "blocked", "slow")
+
+# Parse "valid=0.7,truncated=0.3" (or a single shape name) into (shapes, weights)
+def parse_fake_llm_shapes(spec):
+    shapes, weights = [], []
+    for part in spec.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in FAKE_LLM_SHAPE_NAMES:
+            raise ValueError(f"Unknown fake LLM output shape: {name}")
+        shapes.append(name)
+        weights.append(float(weight) if weight else 1.0)
+    return shapes, weights
+
+# Offline stand-in for Gemini used by benchmarks and load tests. It recognises the
+# study plan, test question, flashcard and explanation prompts and answers them in
+# the expected format, after a simulated latency. Each response has a shape:
+# "valid", "malformed" (a leading chatty line and items with missing fields),
+# "truncated" (cut off mid-response), "continue" (the first half of the items
+# followed by CONTINUE, as the model does when it runs out of output), "blocked"
+# (a safety block) or "slow" (valid, after ten times the latency). Output
+# depends only on the seed, the prompt and how often that prompt was asked.
+class FakeLLMBackend(LLMBackend):
+    model_name = "fake"
+
+    def __init__(self, latency=FAKE_LLM_LATENCY, error_rate=FAKE_LLM_ERROR_RATE, shapes=FAKE_LLM_SHAPES, seed=FAKE_LLM_SEED):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.shapes, self.shape_weights = parse_fake_llm_shapes(shapes)
+        self.seed = seed
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._asked = Counter()  # prompt -> times asked
+
+    def generate(self, prompt, api_key, generation_config=None, timeout=None):
+        with self._lock:
+            self.calls += 1
+            self._asked[prompt] += 1
+            rng = random.Random(f"{self.seed}|{self._asked[prompt]}|{prompt}")
+        delay = self.latency * rng.uniform(0.5, 1.5)
+        failed = rng.random() < self.error_rate
+        shape = rng.choices(self.shapes, self.shape_weights)[0]
+        if shape == "slow":
+            delay *= 10
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise LLMError("Fake LLM backend timed out", "timeout")
+        time.sleep(delay)
+        if failed:
+            raise LLMError("Fake LLM backend error", "transient")
+        if shape == "blocked":
+            raise LLMError("Fake LLM backend blocked the response (SAFETY)", "safety")
+        text = self.respond(prompt, shape, rng)
+        if generation_config and generation_config.get("max_output_tokens"):
+            text = text[:generation_config["max_output_tokens"] * 4]  # cut off at the output limit, as the model does
+        return text
+
+    def stream(self, prompt, api_key, generation_config=None, timeout=None):
+        text = self.generate(prompt, api_key, generation_config, timeout)
+        for start in range(0, len(text), 200):
+            yield text[start:start + 200]
+
+    def respond(self, prompt, shape, rng):
+        blocks = self._blocks(prompt, rng)
+        if shape == "malformed":
+            blocks = ["Sure! Here is what you asked for:"] + [self._malform(block, rng) if rng.random() < 0.3 else block
+                                                              for block in blocks]
+        elif shape == "continue":
+            blocks = blocks[:max(1, len(blocks) // 2)] + ["CONTINUE"]
+        text = "\n\n".join(blocks)
+        if shape == "truncated":
+            text = text[:rng.randint(len(text) // 3, len(text) - 1)]
+        return text
+
+    def _blocks(self, prompt, rng):
+        match = re.search(r"days (\d+) to (\d+) only", prompt)
+        if match:
+            return [f"{day}. {self._phrase(rng, 3).title()}" for day in range(int(match.group(1)), int(match.group(2)) + 1)]
+        match = re.search(r"Generate (\d+) multiple-choice questions .*?'(.+?)'", prompt)
+        if match:
+            return [self._question(match.group(2), rng) for _ in range(int(match.group(1)))]
+        match = re.search(r"Create (\d+) flashcards for '(.+?)'", prompt)
+        if match:
+            return [f"Front: What is the {self._phrase(rng, 5)} in {match.group(2)}?\nBack: {self._phrase(rng, 12)}"
+                    for _ in range(int(match.group(1)))]
+        match = re.search(r"(?:explanation of|Explain) '(.+?)'", prompt)
+        paragraphs = rng.randint(6, 10) if "in-depth" in prompt else rng.randint(2, 3)
+        return [f"## {match.group(1) if match else 'Answer'}"] + [self._phrase(rng, 40) for _ in range(paragraphs)]
+
+    def _question(self, topic, rng):
+        options = [f"{letter}) {self._phrase(rng, 3)}" for letter in "ABCD"]
+        return "\n".join([f"Q: In {topic}, what does the {self._phrase(rng, 6)} do?", *options,
+                          f"Correct: {rng.choice('ABCD')}", f"Explanation: {self._phrase(rng, 10)}"])
+
+    # Drop one field line from a multi-line item, or break the numbering of a one-line item
+    @staticmethod
+    def _malform(block, rng):
+        lines = block.split("\n")
+        if len(lines) > 1:
+            del lines[rng.randrange(1, len(lines))]
+            return "\n".join(lines)
+        return block.replace(". ", " - ", 1)
+
+    @staticmethod
+    def _phrase(rng, words):
+        return " ".join(rng.choice(FAKE_LLM_WORDS) for _ in range(words))
+
+LLM_BACKENDS = {
+    "gemini": GeminiBackend,
+    "fake": FakeLLMBackend,
+}
+
+# Shared by all sessions of this Streamlit process
+@st.cache_resource
+def get_llm_backend():
+    if LLM_BACKEND not in LLM_BACKENDS:
+        raise ValueError(f"Unknown LLM backend: {LLM_BACKEND}")
+    return LLM_BACKENDS[LLM_BACKEND]()
+
+# Token bucket rate limiter for one API key
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate_per_second = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # Take a token and return 0, or return the seconds until one is available
+    def try_acquire(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate_per_second)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate_per_second
+
+# discard is called with the result of an attempt that lost to a hedge, e.g. to
+# close an open stream
+class ScheduledRequest:
+    def __init__(self, fn, api_key, priority, coalesce_key, max_retries, operation, deadline, hedge=False,
+                 attempt_timeout=GEMINI_ATTEMPT_TIMEOUT, discard=None):
+        self.fn = fn
+        self.api_key = api_key
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.max_retries = max_retries
+        self.operation = operation
+        self.submitted_at = time.monotonic()
+        self.deadline = self.submitted_at + deadline
+        self.hedge = hedge
+        self.attempt_timeout = attempt_timeout
+        self.discard = discard
+        self.hedge_of = None  # the request this one hedges
+        self.attempt = 0
+        self.last_error = None
+        self.not_before = 0.0
+        self.seq = None  # sequence number of its live queue entry, None while not queued
+        self.running = False
+        self.future = Future()
+
+# Circuit breaker for one API key. After CIRCUIT_BREAKER_FAILURES consecutive
+# failed attempts the circuit opens and the key's requests fail at once. After
+# the cooldown a single probe request is let through while the others wait; any
+# outcome of the probe settles the circuit: a failure that counts against the
+# key opens it again, anything else closes it.
+class CircuitBreaker:
+    def __init__(self, failures=CIRCUIT_BREAKER_FAILURES, cooldown=CIRCUIT_BREAKER_COOLDOWN):
+        self.failures_to_open = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probe = None  # request running as the half-open probe
+
+    def state(self, now):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if now - self.opened_at >= self.cooldown else "open"
+
+    # Whether a half-open circuit's probe is still running, so other requests must wait
+    def waiting_for_probe(self, now):
+        return self.probe is not None and self.state(now) == "half_open"
+
+    def started(self, request):
+        if self.opened_at is not None and self.probe is None:
+            self.probe = request
+
+    # Forget request as the probe when it leaves the scheduler without an outcome
+    def release(self, request):
+        if self.probe is request:
+            self.probe = None
+
+    # Record an attempt's outcome; failed is whether it counts against the key.
+    # Returns whether the circuit opened.
+    def record(self, request, failed, now):
+        probe, self.probe = self.probe, (None if self.probe is request else self.probe)
+        if not failed:
+            self.failures = 0
+            self.opened_at = None
+            return False
+        self.failures += 1
+        if probe is request or (self.opened_at is None and self.failures >= self.failures_to_open):
+            self.opened_at = now
+            return True
+        return False
+
+# Random delay before retry number attempt of an error kind, or None if the kind isn't retried
+def retry_delay(kind, attempt):
+    policy = GEMINI_RETRY_POLICIES.get(kind, GEMINI_RETRY_POLICIES["transient"])
+    if not policy["retry"]:
+        return None
+    return random.uniform(0, min(GEMINI_BACKOFF_MAX, policy["backoff"] * 2 ** (attempt - 1)))
+
+# Process-wide scheduler for Gemini calls. Requests wait in a priority queue and
+# are started by a fixed set of worker threads (bounding concurrency) once their
+# API key's token bucket and circuit breaker allow it. Requests that can't start
+# yet are set aside instead of being rescanned: backoffs and hedges in a heap by
+# start time, and requests whose key is out of tokens or waiting for its probe
+# in a per-key heap, released one at a time as the key frees up. Failed attempts are
+# classified and re-queued with jittered exponential backoff instead of
+# sleeping; every request fails once its deadline has passed, and each attempt
+# is given at most GEMINI_ATTEMPT_TIMEOUT seconds. Identical requests that are
+# already queued or running share one upstream call. A hedged request gets a
+# second attempt once its first runs unusually long, and the first to succeed wins.
+class GeminiScheduler:
+    def __init__(self, max_concurrency=GEMINI_MAX_CONCURRENCY, rate_per_minute=GEMINI_RATE_LIMIT_PER_MINUTE,
+                 burst=GEMINI_RATE_LIMIT_BURST, metrics=None):
+        self.rate_per_second = rate_per_minute / 60
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.burst = burst
+        self.submitted = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.hedged = 0
+        self.hedges_won = 0
+        self.completed = 0
+        self.failed = 0
+        self._cond = threading.Condition()
+        self._queue = []  # heap of (priority, seq, request) ready to try
+        self._delayed = []  # heap of (not_before, seq, request) backing off or waiting to hedge
+        self._blocked = {}  # api_key -> heap of (priority, submitted_at, seq, request) waiting for the key
+        self._released = {}  # api_key -> blocked request moved back to the queue to try the key
+        self._timers = []  # heap of (time, seq, api_key) when a blocked key gets a token
+        self._deadlines = []  # heap of (deadline, seq, request)
+        self._depth = 0
+        self._seq = itertools.count()
+        self._buckets = {}
+        self._breakers = {}  # api_key -> CircuitBreaker
+        self._in_flight = {}  # coalesce_key -> request
+        self._expired = []  # (request, error) failed by the scheduler, resolved by a worker outside the lock
+        for index in range(max_concurrency):
+            threading.Thread(target=self._worker, name=f"gemini-scheduler-{index}", daemon=True).start()
+
+    def submit(self, fn, api_key, priority=PRIORITY_INTERACTIVE, coalesce_key=None, max_retries=3, operation="other",
+               deadline=None, hedge=False, attempt_timeout=GEMINI_ATTEMPT_TIMEOUT, discard=None):
+        with self._cond:
+            self.submitted += 1
+            request = self._in_flight.get(coalesce_key) if coalesce_key is not None else None
+            if request is not None:
+                self.coalesced += 1
+                self.metrics.inc("gemini_coalesced_total", operation=operation)
+                request.hedge = request.hedge or hedge
+                if priority < request.priority:
+                    # Requeue at the better priority; the stale heap entry is skipped
+                    request.priority = priority
+                    if request.seq is not None:
+                        self._push(request, time.monotonic())
+                return request.future
+            request = ScheduledRequest(fn, api_key, priority, coalesce_key, max_retries, operation,
+                                       deadline or GEMINI_DEADLINES[priority], hedge, attempt_timeout, discard)
+            if self._breaker(api_key).state(request.submitted_at) == "open":
+                self.failed += 1
+                self.metrics.inc("gemini_errors_total", operation=operation, kind="circuit_open")
+                request.future.set_exception(self._circuit_open_error())
+                return request.future
+            if coalesce_key is not None:
+                self._in_flight[coalesce_key] = request
+            self._push(request, request.submitted_at)
+            return request.future
+
+    def queue_depth(self):
+        with self._cond:
+            return self._depth
+
+    # {"closed": n, "open": n, "half_open": n} over the API keys seen so far
+    def circuit_states(self):
+        now = time.monotonic()
+        with self._cond:
+            states = Counter(breaker.state(now) for breaker in self._breakers.values())
+        return {state: states.get(state, 0) for state in ("closed", "open", "half_open")}
+
+    # Caller holds the lock
+    def _breaker(self, api_key):
+        breaker = self._breakers.get(api_key)
+        if breaker is None:
+            breaker = self._breakers[api_key] = CircuitBreaker()
+        return breaker
+
+    @staticmethod
+    def _circuit_open_error():
+        return LLMError("The Gemini API is failing repeatedly for this API key; requests are paused, "
+                        "please try again shortly", "circuit_open")
+
+    # Seconds a hedged request's first attempt may run before the hedge is sent
+    def _hedge_delay(self, operation):
+        delay = self.metrics.percentile("gemini_attempt_seconds", GEMINI_HEDGE_QUANTILE, GEMINI_HEDGE_MIN_SAMPLES,
+                                        operation=operation, outcome="ok")
+        return GEMINI_HEDGE_DEFAULT_DELAY if delay is None else delay
+
+    # Queue a second attempt of request that starts after the hedge delay,
+    # unless the request has completed by then; caller holds the lock
+    def _queue_hedge(self, request, now):
+        hedge = ScheduledRequest(request.fn, request.api_key, request.priority, None, 1, request.operation,
+                                 request.deadline - now, attempt_timeout=request.attempt_timeout,
+                                 discard=request.discard)
+        hedge.hedge_of = request
+        hedge.future = request.future
+        hedge.not_before = now + self._hedge_delay(request.operation)
+        self._push(hedge, now)
+
+    # Fail a queued request without running it; caller holds the lock. A hedge
+    # is just dropped, since its original request is still being handled.
+    def _expire(self, request, error):
+        self._drop(request)
+        if request.hedge_of is None:
+            self._expired.append((request, error))
+
+    # Queue request, or set it aside until its not_before; caller holds the lock.
+    # Entries it already has in the heaps become stale and are skipped when popped.
+    def _push(self, request, now):
+        if request.seq is None:
+            self._depth += 1
+            heapq.heappush(self._deadlines, (request.deadline, next(self._seq), request))
+        request.seq = next(self._seq)
+        if request.not_before > now:
+            heapq.heappush(self._delayed, (request.not_before, request.seq, request))
+        else:
+            heapq.heappush(self._queue, (request.priority, request.seq, request))
+        self._cond.notify()  # idle workers may be waiting for a later time
+
+    # Take request off the queue; caller holds the lock
+    def _unqueue(self, request):
+        if request.seq is not None:
+            self._depth -= 1
+            request.seq = None
+
+    # Park request until its API key frees up, with a timer for when the key
+    # gets a token if until is given; caller holds the lock
+    def _block(self, request, until=None):
+        if self._released.get(request.api_key) is request:
+            del self._released[request.api_key]
+        request.seq = next(self._seq)
+        heapq.heappush(self._blocked.setdefault(request.api_key, []),
+                       (request.priority, request.submitted_at, request.seq, request))
+        if until is not None:
+            heapq.heappush(self._timers, (until, next(self._seq), request.api_key))
+
+    # Move the key's most urgent blocked request back to the queue, unless one
+    # already is; caller holds the lock
+    def _unblock(self, api_key):
+        blocked = self._blocked.get(api_key)
+        if api_key in self._released or blocked is None:
+            return
+        while blocked:
+            _, _, seq, request = heapq.heappop(blocked)
+            if seq == request.seq:
+                self._released[api_key] = request
+                self._push(request, time.monotonic())
+                break
+        if not blocked:
+            del self._blocked[api_key]
+
+    # Pop the most urgent request that may start now; caller holds the lock.
+    # Returns (request, None) or (None, seconds to wait).
+    def _next_request(self):
+        now = time.monotonic()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            request = heapq.heappop(self._deadlines)[2]
+            if request.seq is not None:
+                message = f"Gemini request missed its deadline after {request.attempt} attempt(s)"
+                if request.last_error is not None:
+                    message += f": {request.last_error}"
+                self._expire(request, LLMError(message, "timeout"))
+        while self._delayed and self._delayed[0][0] <= now:
+            _, seq, request = heapq.heappop(self._delayed)
+            if seq == request.seq:
+                self._push(request, now)
+        while self._timers and self._timers[0][0] <= now:
+            self._unblock(heapq.heappop(self._timers)[2])
+        while self._queue:
+            _, seq, request = heapq.heappop(self._queue)
+            if seq != request.seq:
+                continue
+            if request.not_before > now:  # requeued at a better priority while backing off
+                self._push(request, now)
+                continue
+            if request.future.done():
+                self._drop(request)
+                continue
+            breaker = self._breaker(request.api_key)
+            if breaker.state(now) == "open":
+                self._expire(request, self._circuit_open_error())
+                continue
+            released = self._released.get(request.api_key) is request
+            if (request.api_key in self._blocked and not released) or breaker.waiting_for_probe(now):
+                self._block(request)  # woken when the probe finishes or the key's blocked requests move on
+                continue
+            bucket = self._buckets.get(request.api_key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate_per_second, self.burst)
+                self._buckets[request.api_key] = bucket
+            delay = bucket.try_acquire(now)
+            if delay:
+                self._block(request, now + delay)
+                continue
+            self._unqueue(request)
+            if released:
+                del self._released[request.api_key]
+                self._unblock(request.api_key)
+            request.running = True
+            breaker.started(request)
+            if request.hedge and request.attempt == 0:
+                self._queue_hedge(request, now)
+            if request.hedge_of is not None:
+                self.hedged += 1
+                self.metrics.inc("gemini_hedges_total", operation=request.operation, outcome="sent")
+            return request, None
+        waits = [heap[0][0] - now for heap in (self._delayed, self._timers, self._deadlines) if heap]
+        return None, min(waits) if waits else None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                request, wait = self._next_request()
+                while request is None and not self._expired:
+                    self._cond.wait(wait)
+                    request, wait = self._next_request()
+                expired, self._expired = self._expired, []
+            for expired_request, error in expired:
+                self._finish(expired_request, expired_request.attempt, error=error)
+            if request is not None:
+                self._run(request)
+
+    # Remove a request from the queue and the coalescing table; caller holds the lock
+    def _drop(self, request):
+        self._unqueue(request)
+        if request.coalesce_key is not None and self._in_flight.get(request.coalesce_key) is request:
+            del self._in_flight[request.coalesce_key]
+        breaker = self._breakers.get(request.api_key)
+        if breaker is not None:
+            breaker.release(request)
+        if self._released.get(request.api_key) is request:
+            del self._released[request.api_key]
+        self._unblock(request.api_key)
+
+    def _run(self, request):
+        started = time.perf_counter()
+        timeout = max(0.1, min(request.attempt_timeout, request.deadline - time.monotonic()))
+        try:
+            result = request.fn(timeout)
+        except Exception as e:
+            kind = classify_llm_error(e)
+            self.metrics.observe("gemini_attempt_seconds", time.perf_counter() - started,
+                                 operation=request.operation, outcome="error")
+            self.metrics.inc("gemini_errors_total", operation=request.operation, kind=kind)
+            request.attempt += 1
+            request.last_error = e
+            with self._cond:
+                request.running = False
+                now = time.monotonic()
+                # Other kinds mean the service answered, which clears the key's failure streak
+                if self._breaker(request.api_key).record(request, kind in CIRCUIT_BREAKER_KINDS, now):
+                    self.metrics.inc("gemini_circuit_opened_total")
+                self._unblock(request.api_key)  # the probe, if this was it, has finished
+                if kind == "quota":
+                    # The whole key is over quota: hold back its other requests too
+                    bucket = self._buckets.get(request.api_key)
+                    if bucket is not None:
+                        bucket.tokens = min(bucket.tokens, 0) - self.rate_per_second * GEMINI_RETRY_POLICIES["quota"]["backoff"]
+                self._cond.notify_all()
+                if request.hedge_of is not None or request.future.done():
+                    self._drop(request)
+                    return  # a hedge leaves retries to its original; a call a hedge won needs none
+                delay = retry_delay(kind, request.attempt)
+                if delay is not None and request.attempt < request.max_retries and now + delay < request.deadline:
+                    self.retried += 1
+                    self.metrics.inc("gemini_retries_total", operation=request.operation)
+                    request.not_before = now + delay
+                    self._push(request, now)
+                    return
+                self._drop(request)
+            if kind == "safety":
+                error = LLMError(f"The request was blocked by the Gemini API's safety filters: {str(e)}", kind)
+            else:
+                error = LLMError(f"Error querying Gemini API after {request.attempt} attempt(s): {str(e)}", kind)
+            self._finish(request, request.attempt, error=error)
+        else:
+            self.metrics.observe("gemini_attempt_seconds", time.perf_counter() - started,
+                                 operation=request.operation, outcome="ok")
+            with self._cond:
+                request.running = False
+                self._breaker(request.api_key).record(request, False, time.monotonic())
+                self._cond.notify_all()
+                self._drop(request)
+                original = request.hedge_of
+                # A winning hedge counts itself, the original's failed attempts and its running one
+                attempts = request.attempt + 1 if original is None else original.attempt + 1 + original.running
+            if self._finish(request, attempts, result=result):
+                if original is not None:
+                    with self._cond:
+                        self.hedges_won += 1
+                    self.metrics.inc("gemini_hedges_total", operation=request.operation, outcome="won")
+            elif request.discard is not None:
+                request.discard(result)
+
+    # Settle the call with this attempt's outcome and record it, unless another
+    # attempt of the call (its hedge, or the original a hedge raced) settled it
+    # first; a call is counted once, with the latency its caller saw. Returns
+    # whether this attempt settled it.
+    def _finish(self, request, attempts, result=None, error=None):
+        if not self._resolve(request, result, error):
+            return False
+        with self._cond:
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+        self._record_call(request.hedge_of or request, attempts, "ok" if error is None else "error")
+        return True
+
+    # End-to-end latency of a request, including queueing, backoff and retries
+    def _record_call(self, request, attempts, outcome):
+        self.metrics.observe("gemini_call_seconds", time.monotonic() - request.submitted_at,
+                             operation=request.operation, outcome=outcome)
+        self.metrics.observe("gemini_attempts", attempts, ATTEMPT_BUCKETS, operation=request.operation)
+        self.metrics.inc("gemini_requests_total", operation=request.operation, outcome=outcome)
+
+    # Settle the request's future unless it is already settled (cancelled, or
+    # won by a hedge); returns whether this call settled it
+    @staticmethod
+    def _resolve(request, result=None, error=None):
+        try:
+            if error is not None:
+                request.future.set_exception(error)
+            else:
+                request.future.set_result(result)
+            return True
+        except InvalidStateError:
+            return False
+
+@st.cache_resource
+def get_gemini_scheduler():
+    return GeminiScheduler(metrics=get_metrics())
+
+# Queue a Gemini request and return a Future for its text. operation labels the
+# request in metrics, e.g. "explanation" or "study_plan". hedge sends a second
+# attempt when the first is slow; use it for calls a learner is waiting on.
+def submit_gemini_request(prompt, api_key, priority=PRIORITY_INTERACTIVE, max_retries=3, operation="other",
+                          generation_config=None, hedge=False):
+    backend = get_llm_backend()
+    metrics = get_metrics()
+    metrics.observe("gemini_prompt_chars", len(prompt), SIZE_BUCKETS, operation=operation)
+    def request(timeout):
+        text = backend.generate(prompt, api_key, generation_config, timeout)
+        metrics.observe("gemini_response_chars", len(text), SIZE_BUCKETS, operation=operation)
+        return text
+    config_key = tuple(sorted(generation_config.items())) if generation_config else None
+    return get_gemini_scheduler().submit(request, api_key, priority, (api_key, backend.model_name, prompt, config_key),
+                                         max_retries, operation, hedge=hedge)
+
+# Wait for a scheduled request. The scheduler fails requests at their deadline;
+# the timeout here also bounds the wait when every worker is busy.
+def gemini_result(future, priority):
+    try:
+        return future.result(timeout=GEMINI_DEADLINES[priority])
+    except TimeoutError:
+        raise LLMError(f"Gemini request timed out after {GEMINI_DEADLINES[priority]} seconds", "timeout") from None
 
 # Function to query the Gemini API
-def query_gemini_api(prompt, api_key, max_retries=3):
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-pro')
-    
-    for attempt in range(max_retries):
+def query_gemini_api(prompt, api_key, max_retries=3, priority=PRIORITY_INTERACTIVE, operation="other", generation_config=None,
+                     hedge=False):
+    return gemini_result(submit_gemini_request(prompt, api_key, priority, max_retries, operation, generation_config, hedge),
+                         priority)
+
+# Raised when a streamed response breaks after part of the answer was already yielded
+class StreamInterruptedError(ValueError):
+    def __init__(self, message, partial_text):
+        super().__init__(message)
+        self.partial_text = partial_text
+
+# One upstream stream shared by every caller that asks for the same prompt while
+# it is open. Each reader replays the chunks received so far and then pulls the
+# next one itself, one reader at a time, so the stream keeps going as long as
+# anyone reads it; it is closed when the last reader leaves. An error ends the
+# stream for every reader.
+class SharedStream:
+    def __init__(self, source):
+        self.readers = 0
+        self._source = source
+        self._chunks = []
+        self._done = False
+        self._error = None
+        self._lock = threading.Lock()
+        self._pull_lock = threading.Lock()
+
+    def read(self):
+        index = 0
+        while True:
+            with self._lock:
+                available = index < len(self._chunks)
+            if not available:
+                with self._pull_lock:
+                    with self._lock:
+                        if self._error is not None:
+                            raise self._error
+                        if self._done and index == len(self._chunks):
+                            return
+                        pull = index == len(self._chunks)
+                    if pull:
+                        try:
+                            chunk = next(self._source)
+                        except StopIteration:
+                            with self._lock:
+                                self._done = True
+                            return
+                        except Exception as e:
+                            with self._lock:
+                                self._error = e
+                            raise
+                        with self._lock:
+                            self._chunks.append(chunk)
+            with self._lock:
+                chunk = self._chunks[index]
+            index += 1
+            yield chunk
+
+    def close(self):
+        self._source.close()
+
+# Shared streams by request key; a caller joins the open stream for its key or
+# starts one
+class SharedStreams:
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    # Yields the chunks of the stream for key, opening it with open_source() if
+    # there is none; join_hook is called when an open stream is joined
+    def read(self, key, open_source, join_hook=None):
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None:
+                stream = self._streams[key] = SharedStream(open_source())
+            elif join_hook is not None:
+                join_hook()
+            stream.readers += 1
+        try:
+            yield from stream.read()
+        finally:
+            with self._lock:
+                stream.readers -= 1
+                last = not stream.readers
+                if last:
+                    del self._streams[key]
+            if last:
+                stream.close()
+
+@st.cache_resource
+def get_shared_streams():
+    return SharedStreams()
+
+# Streaming variant of query_gemini_api: yields text chunks as they arrive.
+# Opening the stream and reading its first chunk goes through the scheduler, so
+# it is rate limited, retried and hedged like any other request; a failure after
+# output has been yielded raises StreamInterruptedError so the caller can fall
+# back to a blocking request. Identical prompts streamed at the same time share
+# one upstream stream (see SharedStream).
+def query_gemini_api_stream(prompt, api_key, max_retries=3, priority=PRIORITY_INTERACTIVE, operation="stream",
+                            generation_config=None, hedge=False):
+    config_key = tuple(sorted(generation_config.items())) if generation_config else None
+    key = (api_key, get_llm_backend().model_name, prompt, config_key)
+    yield from get_shared_streams().read(
+        key, lambda: open_gemini_stream(prompt, api_key, max_retries, priority, operation, generation_config, hedge),
+        lambda: get_metrics().inc("gemini_coalesced_total", operation=operation))
+
+def open_gemini_stream(prompt, api_key, max_retries, priority, operation, generation_config, hedge):
+    backend = get_llm_backend()
+    metrics = get_metrics()
+    metrics.observe("gemini_prompt_chars", len(prompt), SIZE_BUCKETS, operation=operation)
+
+    # An attempt gets GEMINI_STREAM_TIMEOUT seconds (less near the request
+    # deadline) for the whole stream: the backend's request timeout cuts off a
+    # hung chunk, and the reader below stops at the same deadline
+    def open_stream(timeout):
+        stream_deadline = time.monotonic() + timeout
+        chunks = iter(backend.stream(prompt, api_key, generation_config, timeout))
+        for text in chunks:
+            if text:
+                return text, chunks, stream_deadline
+        raise LLMError("No valid response from the Gemini API", "transient")
+
+    received, chunks, stream_deadline = gemini_result(get_gemini_scheduler().submit(
+        open_stream, api_key, priority, max_retries=max_retries, operation=operation, hedge=hedge,
+        attempt_timeout=GEMINI_STREAM_TIMEOUT, discard=lambda result: result[1].close()), priority)
+    yield received
+    with metrics.timer("gemini_stream_seconds", operation=operation):
         try:
-            response = model.generate_content(prompt)
-            if response and response.text:
-                return response.text
+            for text in chunks:
+                if time.monotonic() > stream_deadline:
+                    raise LLMError("Gemini stream timed out", "timeout")
+                if text:
+                    received += text
+                    yield text
         except Exception as e:
-            if attempt == max_retries - 1:
-                raise ValueError(f"Error querying Gemini API after {max_retries} attempts: {str(e)}")
-            time.sleep(2 ** attempt)  # Exponential backoff
-    
-    raise ValueError("No valid response from the Gemini API")
+            raise StreamInterruptedError(f"Gemini stream interrupted: {str(e)}", received)
+        finally:
+            chunks.close()
+    metrics.observe("gemini_response_chars", len(received), SIZE_BUCKETS, operation=operation)
 
-# Function to generate a study plan
-def generate_study_plan(language, time_frame, level, api_key):
-    prompt = f"""
-    Create a {time_frame}-day course plan for learning {language} programming at {level} level. 
-    Provide a daily topic breakdown in the following format:
-    
-    1. Topic 1
-    2. Topic 2
-    3. Topic 3
+def chunk_text(chunk):
+    try:
+        return chunk.text
+    except ValueError:  # chunk without text parts, e.g. the final finish_reason chunk
+        return ""
+
+# Submit fn to an executor with the caller's ScriptRunContext attached, so the worker
+# thread can use st.cache_resource-shared objects the same way the script thread does
+def submit_with_script_context(executor, fn, *args, **kwargs):
+    ctx = get_script_run_ctx(suppress_warning=True)
+    def run():
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+    return executor.submit(run)
+
+# Split days first..last into consecutive (start, end) ranges of at most chunk_size days
+def plan_day_ranges(days, chunk_size=PLAN_CHUNK_DAYS):
+    ranges = []
+    for day in sorted(days):
+        if ranges and day == ranges[-1][1] + 1 and day - ranges[-1][0] < chunk_size:
+            ranges[-1] = (ranges[-1][0], day)
+        else:
+            ranges.append((day, day))
+    return ranges
+
+# Rough token count for budgeting: about four characters per token in English
+# text and code
+def estimate_tokens(text):
+    return math.ceil(len(text) / 4)
+
+# A topic, language or level as inserted into a prompt: whitespace collapsed,
+# surrounding quotes and Markdown emphasis removed, and clipped to max_tokens
+def prompt_value(value, max_tokens=PROMPT_VALUE_MAX_TOKENS):
+    text = " ".join(str(value).split()).strip("'\"`* ")
+    max_chars = max_tokens * 4
+    return text if len(text) <= max_chars else text[:max_chars - 1].rstrip() + "…"
+
+# Finish a prompt template for an operation: drop the template's indentation and
+# check the estimated size against the operation's prompt budget
+def budget_prompt(operation, prompt):
+    prompt = textwrap.dedent(prompt).strip()
+    tokens = estimate_tokens(prompt)
+    limit = GENERATION_BUDGETS[operation]["prompt_tokens"]
+    if tokens > limit:
+        raise ValueError(f"The {operation} prompt is about {tokens} tokens, over its budget of {limit}")
+    return prompt
+
+# generation_config for one call: the operation's temperature and output token
+# limit, lowered to what the requested items need; None for unbudgeted calls
+def generation_config(operation, items=None):
+    budget = GENERATION_BUDGETS.get(operation)
+    if budget is None:
+        return None
+    max_output_tokens = budget["output_tokens"]
+    if items and budget.get("tokens_per_item"):
+        max_output_tokens = min(max_output_tokens, 64 + items * budget["tokens_per_item"])
+    return {"max_output_tokens": max_output_tokens, "temperature": budget["temperature"]}
+
+def build_study_plan_prompt(language, time_frame, level, start, end):
+    language, level = prompt_value(language), prompt_value(level)
+    if end <= time_frame / 3:
+        stage = "the early part of the course, starting from the fundamentals"
+    elif start > time_frame * 2 / 3:
+        stage = "the final part of the course, building on everything covered before"
+    else:
+        stage = "the middle part of the course, building on the fundamentals covered earlier"
+    return budget_prompt("study_plan", f"""
+    You are planning a {time_frame}-day course for learning {language} programming at {level} level.
+    List the daily topics for days {start} to {end} only. These days are {stage}.
+    Provide exactly one line per day in the following format:
+
+    {start}. Topic {start}
     ...
-    {time_frame}. Topic {time_frame}
-    
+    {end}. Topic {end}
+
     Ensure each topic is concise (1-5 words) and follows a logical progression.
-    If you reach the end of your response before completing all {time_frame} topics, end with 'CONTINUE' on a new line.
-    When all {time_frame} topics are listed, end with 'COMPLETE' on a new line.
-    """
-    
-    full_response = ""
-    while "COMPLETE" not in full_response:
-        response = query_gemini_api(prompt if not full_response else "Continue the list", api_key)
-        full_response += response
-        if "CONTINUE" not in full_response and "COMPLETE" not in full_response:
-            full_response += "\nCONTINUE\n"
-    
-    # Extract topics
-    topics = re.findall(r'\d+\.\s(.+)', full_response)
-    return topics[:time_frame]  # Ensure we only return the requested number of topics
+    Do not include any other text.
+    """)
+
+# Extract {day: topic} for the days start..end from a study plan response.
+# Lines outside the range and repeated day numbers are ignored.
+def parse_study_plan_chunk(response, start, end):
+    topics = {}
+    for line in response.split('\n'):
+        match = re.match(r'^\s*(?:\*\*)?(?:Day\s+)?(\d+)[.:)]\s*(.+)$', line.strip(), re.IGNORECASE)
+        if not match:
+            continue
+        day = int(match.group(1))
+        topic = match.group(2).strip().strip('*').strip()
+        if start <= day <= end and day not in topics and topic:
+            topics[day] = topic
+    return topics
+
+# Function to generate a study plan. Day ranges are requested in parallel and each
+# response is checked against the days it was asked for; only the days that are
+# still missing get re-requested, up to PLAN_MAX_CALLS calls in total.
+@timed("study_plan")
+def generate_study_plan(language, time_frame, level, api_key):
+    topics = {}
+    pending = plan_day_ranges(range(1, time_frame + 1))
+    calls = 0
+    while pending and calls < PLAN_MAX_CALLS:
+        wave = pending[:PLAN_MAX_CALLS - calls]
+        calls += len(wave)
+        futures = {
+            submit_gemini_request(build_study_plan_prompt(language, time_frame, level, start, end), api_key, PRIORITY_BATCH,
+                                  operation="study_plan",
+                                  generation_config=generation_config("study_plan", end - start + 1)): (start, end)
+            for start, end in wave
+        }
+        errors = []
+        for future in as_completed(futures):
+            start, end = futures[future]
+            try:
+                topics.update(parse_study_plan_chunk(future.result(), start, end))
+            except ValueError as e:
+                errors.append(e)
+        if len(errors) == len(wave):
+            raise errors[0]
+        pending = plan_day_ranges(day for day in range(1, time_frame + 1) if day not in topics)
+
+    if pending:
+        missing = ", ".join(f"{start}-{end}" if start != end else str(start) for start, end in pending)
+        raise ValueError(f"Could not generate topics for days {missing} after {calls} requests")
+    return [topics[day] for day in range(1, time_frame + 1)]
+
+# Disk-backed cache of generated explanations, keyed on a hash of the normalized
+# prompt, model name, level and generation config. Entries are evicted when they get too old or when
+# the cache grows past its entry/byte limits (least recently used first).
+class ExplanationCache:
+    def __init__(self, directory, max_entries=2000, max_bytes=50 * 1024 * 1024, max_age_seconds=30 * 24 * 3600):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._index = {}  # key -> (last_used, size)
+        self._total_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(directory, name))
+                self._index[name[:-5]] = (stat.st_mtime, stat.st_size)
+                self._total_bytes += stat.st_size
+
+    @staticmethod
+    def make_key(prompt, model_name, level, generation_config=None):
+        normalized_prompt = " ".join(prompt.split()).casefold()
+        payload = json.dumps([normalized_prompt, model_name, level or "", generation_config or {}], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _discard(self, key):
+        _, size = self._index.pop(key, (0, 0))
+        self._total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        expired_before = time.time() - self.max_age_seconds
+        for key, (last_used, _) in list(self._index.items()):
+            if last_used < expired_before:
+                self._discard(key)
+                self.evictions += 1
+        while self._index and (len(self._index) > self.max_entries or self._total_bytes > self.max_bytes):
+            oldest = min(self._index, key=lambda k: self._index[k][0])
+            self._discard(oldest)
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), "r") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                self._discard(key)
+                self.misses += 1
+                return None
+            now = time.time()
+            if now - entry["created"] > self.max_age_seconds:
+                self._discard(key)
+                self.evictions += 1
+                self.misses += 1
+                return None
+            os.utime(self._path(key), (now, now))
+            self._index[key] = (now, self._index[key][1])
+            self.hits += 1
+            return entry["response"]
+
+    def put(self, key, response):
+        data = json.dumps({"created": time.time(), "response": response})
+        with self._lock:
+            tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            _, old_size = self._index.get(key, (0, 0))
+            size = os.path.getsize(self._path(key))
+            self._index[key] = (time.time(), size)
+            self._total_bytes += size - old_size
+            self._evict()
+
+    def contains(self, key):
+        with self._lock:
+            return key in self._index
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._index),
+                "bytes": self._total_bytes,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+# Shared across all sessions of this Streamlit process
+@st.cache_resource
+def get_explanation_cache():
+    return ExplanationCache(EXPLANATION_CACHE_DIR)
+
+# Build the prompt used for daily topic explanations. The "summary" tier is a
+# short overview; "deep" asks for the full treatment.
+def build_explanation_prompt(topic, language, tier="summary"):
+    topic, language = prompt_value(topic), prompt_value(language)
+    if tier == "summary":
+        return budget_prompt("explanation_summary", f"""
+        Explain '{topic}' in {language} programming to a learner, in at most 300 words:
+        1. What it is and when to use it
+        2. One short code example
+        3. The most common pitfall
+
+        Format your response using Markdown.
+        """)
+    if tier == "deep":
+        return budget_prompt("explanation_deep", f"""
+        Provide an in-depth explanation of '{topic}' in {language} programming. Include:
+        1. Detailed concept explanation
+        2. Code examples
+        3. Best practices
+        4. Common pitfalls
+        5. Up to three related LeetCode problems with short explanations
+        6. Additional resources for further learning
+
+        Format your response using Markdown for better readability.
+        """)
+    raise ValueError(f"Unknown explanation tier: {tier}")
+
+# Cache key of an explanation. The prompt differs per tier, and the generation
+# config is part of the key so a budget change never serves responses of the old size.
+def explanation_cache_key(topic, language, level, tier):
+    return get_explanation_cache().make_key(build_explanation_prompt(topic, language, tier), get_llm_backend().model_name,
+                                            level, generation_config(f"explanation_{tier}"))
+
+# Cached explanation of topic, or of a differently phrased topic of the same
+# language and level, labelled with the topic it was written for; counts the
+# lookup in explanation_cache_total
+def cached_explanation(topic, language, level, tier):
+    cache = get_explanation_cache()
+    cached = cache.get(explanation_cache_key(topic, language, level, tier))
+    if cached is not None:
+        get_metrics().inc("explanation_cache_total", result="hit")
+        return cached
+    for similar in get_explanation_topic_index(language, level).find(topic):
+        similar_key = explanation_cache_key(similar, language, level, tier)
+        if cache.contains(similar_key):
+            cached = cache.get(similar_key)
+            if cached is not None:
+                get_metrics().inc("explanation_cache_total", result="similar")
+                return f"_Explanation of the closely related topic \"{similar}\"._\n\n{cached}"
+    get_metrics().inc("explanation_cache_total", result="miss")
+    return None
+
+def cache_explanation(topic, language, level, tier, response):
+    get_explanation_cache().put(explanation_cache_key(topic, language, level, tier), response)
+    get_explanation_topic_index(language, level).add(topic)
 
 # Function to explain the daily topic
-def explain_topic(topic, language, api_key):
-    prompt = f"""
-    Provide an in-depth explanation of '{topic}' in {language} programming. Include:
-    1. Detailed concept explanation
-    2. Code examples
-    3. Best practices
-    4. Common pitfalls
-    5. Related LeetCode problems with explanations
-    6. Additional resources for further learning
-
-    Format your response using Markdown for better readability.
+@timed("explanation")
+def explain_topic(topic, language, api_key, level=None, priority=PRIORITY_INTERACTIVE, tier="summary"):
+    cached = cached_explanation(topic, language, level, tier)
+    if cached is not None:
+        return cached
+    return request_explanation(topic, language, api_key, level, priority, tier)
+
+# Query and cache an explanation without looking in the cache first. The request
+# is coalesced with an identical one in flight, e.g. a prefetch of the topic.
+def request_explanation(topic, language, api_key, level=None, priority=PRIORITY_INTERACTIVE, tier="summary"):
+    prompt = build_explanation_prompt(topic, language, tier)
+    operation = "explanation_prefetch" if priority == PRIORITY_PREFETCH else f"explanation_{tier}"
+    response = query_gemini_api(prompt, api_key, priority=priority, operation=operation,
+                                generation_config=generation_config(f"explanation_{tier}"),
+                                hedge=priority == PRIORITY_INTERACTIVE).strip()
+    if response:
+        cache_explanation(topic, language, level, tier, response)
+    return response
+
+# Streaming variant of explain_topic; the full text is cached once the stream
+# completes. A topic that is being prefetched isn't streamed a second time: the
+# prefetch is joined at interactive priority and its text yielded whole.
+def explain_topic_stream(topic, language, api_key, level=None, tier="summary"):
+    prompt = build_explanation_prompt(topic, language, tier)
+    cached = cached_explanation(topic, language, level, tier)
+    if cached is not None:
+        yield cached
+        return
+    if get_explanation_prefetcher().is_in_flight(explanation_cache_key(topic, language, level, tier)):
+        yield request_explanation(topic, language, api_key, level, tier=tier)
+        return
+    response = ""
+    for chunk in query_gemini_api_stream(prompt, api_key, operation=f"explanation_{tier}_stream",
+                                         generation_config=generation_config(f"explanation_{tier}"), hedge=True):
+        response += chunk
+        yield chunk
+    if response.strip():
+        cache_explanation(topic, language, level, tier, response.strip())
+
+# Warms the explanation cache for upcoming days on a thread pool shared by all
+# sessions. Each API key runs at most per_key_limit prefetches at a time; the
+# rest wait in a per-key queue. Scheduling for a different course cancels the
+# owner's queued work.
+class ExplanationPrefetcher:
+    def __init__(self, max_workers=PREFETCH_WORKERS, per_key_limit=PREFETCH_PER_KEY_LIMIT):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.per_key_limit = per_key_limit
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._pending = {}  # api_key -> deque of jobs
+        self._running = {}  # api_key -> number of running jobs
+        self._in_flight = set()  # cache keys queued or running
+        self._owners = {}  # owner -> (course, cancel_event)
+
+    # Whether the explanation with this cache key is queued or being prefetched
+    def is_in_flight(self, cache_key):
+        with self._lock:
+            return cache_key in self._in_flight
+
+    def cancel(self, owner):
+        with self._lock:
+            entry = self._owners.pop(owner, None)
+        if entry:
+            entry[1].set()
+
+    def schedule(self, owner, course, topics, language, api_key, level):
+        with self._lock:
+            entry = self._owners.get(owner)
+        if entry and entry[0] != course:
+            self.cancel(owner)
+            entry = None
+        if entry is None:
+            entry = (course, threading.Event())
+            with self._lock:
+                self._owners[owner] = entry
+        cancel_event = entry[1]
+
+        cache = get_explanation_cache()
+        with self._lock:
+            for topic in topics:
+                cache_key = explanation_cache_key(topic, language, level, "summary")
+                if cache_key in self._in_flight or cache.contains(cache_key):
+                    continue
+                self._in_flight.add(cache_key)
+                job = (cache_key, cancel_event, topic, language, api_key, level)
+                self._pending.setdefault(api_key, deque()).append(job)
+            self._dispatch(api_key)
+
+    # Start queued jobs for api_key while it has free slots; caller holds the lock
+    def _dispatch(self, api_key):
+        pending = self._pending.get(api_key)
+        while pending and self._running.get(api_key, 0) < self.per_key_limit:
+            job = pending.popleft()
+            if job[1].is_set():
+                self._in_flight.discard(job[0])
+                continue
+            self._running[api_key] = self._running.get(api_key, 0) + 1
+            submit_with_script_context(self._executor, self._run, job)
+        if not pending:
+            self._pending.pop(api_key, None)
+
+    def _run(self, job):
+        cache_key, cancel_event, topic, language, api_key, level = job
+        succeeded = None
+        try:
+            if not cancel_event.is_set():
+                explain_topic(topic, language, api_key, level, PRIORITY_PREFETCH)
+                succeeded = True
+        except Exception:
+            succeeded = False
+        finally:
+            with self._lock:
+                if succeeded is not None:
+                    if succeeded:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                self._in_flight.discard(cache_key)
+                self._running[api_key] -= 1
+                if not self._running[api_key]:
+                    del self._running[api_key]
+                self._dispatch(api_key)
+
+@st.cache_resource
+def get_explanation_prefetcher():
+    return ExplanationPrefetcher()
+
+# Prefetch explanations for the current day and the next PREFETCH_AHEAD_DAYS topics
+# whenever a course is opened or its day changes
+def prefetch_upcoming_explanations(language, course):
+    if PREFETCH_AHEAD_DAYS <= 0 or not st.session_state.gemini_api_key:
+        return
+    current_day = course.current_day
+    if st.session_state.get('prefetched_for') == (language, current_day):
+        return
+    st.session_state.prefetched_for = (language, current_day)
+    if 'prefetch_owner' not in st.session_state:
+        st.session_state.prefetch_owner = uuid.uuid4().hex
+    topics = course_topics(language, current_day, PREFETCH_AHEAD_DAYS + 1)
+    get_explanation_prefetcher().schedule(st.session_state.prefetch_owner, language, topics, language,
+                                          st.session_state.gemini_api_key, course.level)
+
+def normalize_text(text):
+    return " ".join(re.sub(r"[^\w\s]", " ", text.casefold()).split())
+
+# Question or card text without case and spacing differences. Punctuation is
+# kept: in code, "7 // 2" and "7 % 2" are different questions.
+def compact_text(text):
+    return " ".join(text.casefold().split())
+
+def text_fingerprint(text):
+    return hashlib.sha256(compact_text(text).encode("utf-8")).hexdigest()
+
+# A question's stem and options, so questions that share a stem but offer
+# different options are told apart
+def question_text(question):
+    return "\n".join([question["question"], *question.get("options", [])])
+
+# MinHash signature of a text's character shingles, using one-permutation hashing:
+# each shingle is hashed once into one of MINHASH_BINS bins, which keep their
+# minimum. Empty bins borrow from the next non-empty one so that LSH bands are
+# always full; the returned bitmask records which bins the text filled itself.
+def minhash_signature(normalized):
+    shingles = {normalized[i:i + SHINGLE_SIZE] for i in range(max(1, len(normalized) - SHINGLE_SIZE + 1))}
+    empty = 0xFFFFFFFF
+    bins = [empty] * MINHASH_BINS
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+        slot = value % MINHASH_BINS
+        value = (value // MINHASH_BINS) & 0xFFFFFFFF
+        if value < bins[slot]:
+            bins[slot] = value
+    filled = sum(1 << slot for slot in range(MINHASH_BINS) if bins[slot] != empty)
+    for slot in range(MINHASH_BINS):
+        offset = 1
+        while bins[slot] == empty and offset < MINHASH_BINS:
+            bins[slot] = bins[(slot + offset) % MINHASH_BINS]
+            offset += 1
+    return array("I", bins), filled
+
+# Estimated Jaccard similarity of two signatures, counting only bins that at least
+# one of the texts filled itself (borrowed bins would inflate it for short texts)
+def minhash_similarity(signature, filled, other, other_filled):
+    either = filled | other_filled
+    both = filled & other_filled
+    matches = sum(1 for slot in range(MINHASH_BINS) if both >> slot & 1 and signature[slot] == other[slot])
+    return matches / bin(either).count("1")
+
+# Exact and near-duplicate lookup for the texts of one deck or question bank.
+# Exact matches use a 64-bit prefix of text_fingerprint; near duplicates are
+# found by LSH over MinHash bands and confirmed by the fraction of matching bins.
+# With by_group, near duplicates are only looked for among texts of the same
+# group (a question's topic), while exact duplicates are found across groups.
+# Holds at most max_entries texts, dropping the oldest first.
+class FingerprintIndex:
+    def __init__(self, max_entries=FINGERPRINT_INDEX_MAX_PER_SCOPE, threshold=NEAR_DUPLICATE_THRESHOLD, by_group=False):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.by_group = by_group
+        self._rows = MINHASH_BINS // MINHASH_BANDS
+        self._entries = OrderedDict()  # entry id -> (exact key, signature, filled bins, group)
+        self._exact = {}  # exact key -> entry id
+        self._buckets = {}  # hash of (group, band, band bins) -> entry id, or list of ids when shared
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.exact_duplicates = 0
+        self.near_duplicates = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _bands(self, signature, group):
+        for band in range(MINHASH_BANDS):
+            yield hash((group, band, signature[band * self._rows:(band + 1) * self._rows].tobytes()))
+
+    def _match(self, exact_key, signature, filled, group):
+        if exact_key in self._exact:
+            return "exact"
+        candidates = set()
+        for band_key in self._bands(signature, group):
+            bucket = self._buckets.get(band_key)
+            if isinstance(bucket, list):
+                candidates.update(bucket)
+            elif bucket is not None:
+                candidates.add(bucket)
+        for entry_id in candidates:
+            _, other, other_filled, _ = self._entries[entry_id]
+            if minhash_similarity(signature, filled, other, other_filled) >= self.threshold:
+                return "near"
+        return None
+
+    @staticmethod
+    def _keys(text):
+        compact = compact_text(text)
+        if not compact:
+            return None, None, None
+        return (int(text_fingerprint(text)[:16], 16), *minhash_signature(compact))
+
+    # "exact", "near" or None
+    def find_duplicate(self, text, group=None):
+        exact_key, signature, filled = self._keys(text)
+        if exact_key is None:
+            return None
+        with self._lock:
+            return self._match(exact_key, signature, filled, group if self.by_group else None)
+
+    # Index the text unless it duplicates one already indexed; returns whether it was added
+    def add(self, text, group=None):
+        exact_key, signature, filled = self._keys(text)
+        if exact_key is None:
+            return True
+        group = group if self.by_group else None
+        with self._lock:
+            match = self._match(exact_key, signature, filled, group)
+            if match == "exact":
+                self.exact_duplicates += 1
+                return False
+            if match == "near":
+                self.near_duplicates += 1
+                return False
+            entry_id = next(self._ids)
+            self._entries[entry_id] = (exact_key, signature, filled, group)
+            self._exact[exact_key] = entry_id
+            for band_key in self._bands(signature, group):
+                bucket = self._buckets.get(band_key)
+                if bucket is None:
+                    self._buckets[band_key] = entry_id
+                elif isinstance(bucket, list):
+                    bucket.append(entry_id)
+                else:
+                    self._buckets[band_key] = [bucket, entry_id]
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+            return True
+
+    def _evict_oldest(self):
+        entry_id, (exact_key, signature, _, group) = self._entries.popitem(last=False)
+        del self._exact[exact_key]
+        for band_key in self._bands(signature, group):
+            bucket = self._buckets[band_key]
+            if isinstance(bucket, list):
+                bucket.remove(entry_id)
+                if len(bucket) == 1:
+                    self._buckets[band_key] = bucket[0]
+            else:
+                del self._buckets[band_key]
+        self.evicted += 1
+
+# Fingerprint indexes by scope, e.g. ("flashcards", user, language). An index is
+# built on first use from the (text, group) pairs that load returns; least
+# recently used scopes are dropped once all indexes together hold more than
+# max_entries texts.
+class FingerprintIndexRegistry:
+    def __init__(self, max_entries=FINGERPRINT_INDEX_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, scope, load, **index_options):
+        with self._lock:
+            index = self._indexes.get(scope)
+            if index is None:
+                index = FingerprintIndex(**index_options)
+                for text, group in load():
+                    index.add(text, group)
+                self._indexes[scope] = index
+            self._indexes.move_to_end(scope)
+            while len(self._indexes) > 1 and sum(len(i) for i in self._indexes.values()) > self.max_entries:
+                self._indexes.popitem(last=False)
+            return index
+
+    def stats(self):
+        with self._lock:
+            indexes = list(self._indexes.values())
+        return {
+            "scopes": len(indexes),
+            "entries": sum(len(index) for index in indexes),
+            "exact_duplicates": sum(index.exact_duplicates for index in indexes),
+            "near_duplicates": sum(index.near_duplicates for index in indexes),
+            "evicted": sum(index.evicted for index in indexes),
+        }
+
+@st.cache_resource
+def get_fingerprint_indexes():
+    return FingerprintIndexRegistry()
+
+# Card fronts of one user's deck
+def get_flashcard_index(user, language):
+    storage = get_storage()
+    return get_fingerprint_indexes().get(
+        ("flashcards", user, language),
+        lambda: [(front, None) for front in storage.load_flashcard_fronts(user, language, FINGERPRINT_INDEX_MAX_PER_SCOPE)])
+
+# Questions banked for a language and level with their options. A question
+# repeated word for word is a duplicate whatever its topic; a near duplicate
+# only within its topic, since questions on neighbouring topics legitimately
+# differ by a word ("define a function" / "define a class").
+def get_question_index(language, level):
+    storage = get_storage()
+    return get_fingerprint_indexes().get(
+        ("questions", language, level),
+        lambda: storage.load_bank_question_texts(language, level, FINGERPRINT_INDEX_MAX_PER_SCOPE),
+        threshold=QUESTION_NEAR_DUPLICATE_THRESHOLD, by_group=True)
+
+# Content words of a study plan topic: without filler words and without the
+# words in ignore (the course language's name)
+def topic_words(topic, ignore=frozenset()):
+    return frozenset(word for word in normalize_text(topic).split() if word not in TOPIC_STOPWORDS and word not in ignore)
+
+def word_ngrams(word):
+    padded = f"<{word}>"
+    return {padded[i:i + TOPIC_NGRAM_SIZE] for i in range(max(1, len(padded) - TOPIC_NGRAM_SIZE + 1))}
+
+# Whether every word of each topic is a form of some word of the other, so
+# "Reading Files" matches "File Reading" but "Binary Search Trees" does not
+# match "Binary Search", nor "Part 2" "Part 1"
+def same_topic_words(words, other):
+    def covered(words, other):
+        return all(any(word == candidate or len(word_ngrams(word) & word_ngrams(candidate)) >=
+                       TOPIC_WORD_MATCH * len(word_ngrams(word) | word_ngrams(candidate)) for candidate in other)
+                   for word in words)
+    return covered(words, other) and covered(other, words)
+
+# Unit-length hashed n-gram vector of a study plan topic. Each content word
+# contributes itself and its character n-grams, hashed with a random sign into
+# TOPIC_VECTOR_SIZE slots, so word order, case, punctuation and filler words
+# don't matter and inflections ("Loop", "Loops") still mostly overlap.
+def topic_vector(topic, ignore=frozenset()):
+    features = []
+    for word in topic_words(topic, ignore):
+        features.append(word)
+        features.extend(word_ngrams(word))
+    vector = np.zeros(TOPIC_VECTOR_SIZE, dtype=np.float32)
+    if not features:
+        return vector
+    hashes = np.array([int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+                       for feature in features], dtype=np.uint64)
+    signs = np.where(hashes >> np.uint64(63), np.float32(-1), np.float32(1))
+    np.add.at(vector, (hashes % np.uint64(TOPIC_VECTOR_SIZE)).astype(np.intp), signs)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+# Study plan topics of one language and level, searched by cosine similarity of
+# their topic vectors: one matrix-vector product over all indexed topics.
+# Candidates above the threshold only match when their content words are the
+# same up to inflection (see same_topic_words), since a shared prefix like
+# "Binary Search" scores high without being the same topic. Holds at most
+# max_entries topics, overwriting the oldest first.
+class TopicSimilarityIndex:
+    def __init__(self, language="", max_entries=TOPIC_INDEX_MAX_PER_SCOPE, threshold=TOPIC_SIMILARITY_THRESHOLD):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._ignore = frozenset(normalize_text(language).split())
+        self._vectors = np.zeros((min(64, max_entries), TOPIC_VECTOR_SIZE), dtype=np.float32)
+        self._topics = []  # topic per row
+        self._words = []  # content words of the topic per row
+        self._rows = {}  # topic -> row
+        self._next = 0  # row written next once the index is full
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.matches = 0
+
+    def __len__(self):
+        return len(self._topics)
+
+    def add(self, topic):
+        vector = topic_vector(topic, self._ignore)
+        with self._lock:
+            if topic in self._rows:
+                return
+            if len(self._topics) < self.max_entries:
+                row = len(self._topics)
+                if row == len(self._vectors):
+                    grown = np.zeros((min(2 * row, self.max_entries), TOPIC_VECTOR_SIZE), dtype=np.float32)
+                    grown[:row] = self._vectors
+                    self._vectors = grown
+                self._topics.append(topic)
+                self._words.append(None)
+            else:
+                row = self._next
+                self._next = (row + 1) % self.max_entries
+                del self._rows[self._topics[row]]
+                self._topics[row] = topic
+            self._vectors[row] = vector
+            self._words[row] = topic_words(topic, self._ignore)
+            self._rows[topic] = row
+
+    # Indexed topics other than topic itself whose similarity reaches the
+    # threshold, most similar first
+    def find(self, topic, limit=TOPIC_SIMILARITY_CANDIDATES):
+        vector = topic_vector(topic, self._ignore)
+        words = topic_words(topic, self._ignore)
+        with self._lock:
+            self.lookups += 1
+            if not self._topics or not vector.any():
+                return []
+            scores = self._vectors[:len(self._topics)] @ vector
+            if topic in self._rows:
+                scores[self._rows[topic]] = -1
+            rows = np.flatnonzero(scores >= self.threshold)
+            rows = rows[np.argsort(scores[rows])[::-1]]
+            similar = [self._topics[row] for row in rows if same_topic_words(words, self._words[row])][:limit]
+            if similar:
+                self.matches += 1
+            return similar
+
+# Topic indexes by scope, e.g. ("explanations", language, level). An index is
+# built from storage on first use; least recently used scopes are dropped once
+# all indexes together hold more than max_entries topics.
+class TopicIndexRegistry:
+    def __init__(self, max_entries=TOPIC_INDEX_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, scope, language, load_topics):
+        with self._lock:
+            index = self._indexes.get(scope)
+            if index is None:
+                index = TopicSimilarityIndex(language)
+                for topic in load_topics():
+                    index.add(topic)
+                self._indexes[scope] = index
+            self._indexes.move_to_end(scope)
+            while len(self._indexes) > 1 and sum(len(i) for i in self._indexes.values()) > self.max_entries:
+                self._indexes.popitem(last=False)
+            return index
+
+    def stats(self):
+        with self._lock:
+            indexes = list(self._indexes.values())
+        return {
+            "scopes": len(indexes),
+            "topics": sum(len(index) for index in indexes),
+            "lookups": sum(index.lookups for index in indexes),
+            "matches": sum(index.matches for index in indexes),
+        }
+
+@st.cache_resource
+def get_topic_indexes():
+    return TopicIndexRegistry()
+
+# Topics of all courses in a language and level; an explanation cached for any
+# of them can stand in for a similar topic
+def get_explanation_topic_index(language, level):
+    storage = get_storage()
+    return get_topic_indexes().get(
+        ("explanations", language, level or ""), language,
+        lambda: storage.load_course_topics(language, level or "", TOPIC_INDEX_MAX_PER_SCOPE))
+
+# Topics with banked questions in a language and level
+def get_bank_topic_index(language, level):
+    storage = get_storage()
+    return get_topic_indexes().get(
+        ("bank", language, level or ""), language,
+        lambda: storage.load_bank_topics(language, level or "", TOPIC_INDEX_MAX_PER_SCOPE))
+
+# Interface for persisted learner state. Courses, progress, tests, flashcards and
+# points are all keyed by user (and language where it applies). Backends must be
+# safe to share between Streamlit sessions and worker threads.
+class StorageBackend:
+    # Group several writes into one atomic transaction
+    def transaction(self):
+        raise NotImplementedError
+
+    def create_user(self, user, password_hash, salt):
+        raise NotImplementedError
+
+    def load_user(self, user):
+        raise NotImplementedError
+
+    def has_users(self):
+        raise NotImplementedError
+
+    def save_course(self, user, language, data):
+        raise NotImplementedError
+
+    def update_course_day(self, user, language, current_day):
+        raise NotImplementedError
+
+    def load_course(self, user, language):
+        raise NotImplementedError
+
+    def load_courses(self, user):
+        raise NotImplementedError
+
+    # Course metadata and plan_length, without the study plan
+    def load_course_summaries(self, user):
+        raise NotImplementedError
+
+    def load_study_plan(self, user, language):
+        raise NotImplementedError
+
+    # Topics of days start + 1 to start + count (start is 0-based)
+    def load_study_plan_page(self, user, language, start, count):
+        raise NotImplementedError
+
+    def add_progress_day(self, user, language, day):
+        raise NotImplementedError
+
+    def save_progress(self, user, language, days):
+        raise NotImplementedError
+
+    def load_progress(self, user, language):
+        raise NotImplementedError
+
+    def save_test(self, user, language, test):
+        raise NotImplementedError
+
+    def load_tests(self, user, language):
+        raise NotImplementedError
+
+    def load_test(self, user, language, number):
+        raise NotImplementedError
+
+    # {language: [{'number', 'score'}, ...]} without questions or answers
+    def load_test_summaries(self, user):
+        raise NotImplementedError
+
+    # Returns the ids assigned to the new cards
+    def add_flashcards(self, user, language, flashcards):
+        raise NotImplementedError
+
+    # Schedules (id, ease, interval, reps, due) of the limit earliest-due cards,
+    # ordered by (due, id)
+    def load_due_flashcards(self, user, language, limit):
+        raise NotImplementedError
+
+    # (front, back) of a card
+    def load_flashcard_text(self, card_id):
+        raise NotImplementedError
+
+    def load_flashcard_languages(self, user):
+        raise NotImplementedError
+
+    # Fronts of the newest limit cards, oldest first
+    def load_flashcard_fronts(self, user, language, limit):
+        raise NotImplementedError
+
+    # Store a card's spaced repetition state after a review
+    def update_flashcard_schedule(self, card_id, ease, interval, reps, due):
+        raise NotImplementedError
+
+    # Shared question bank, indexed by (language, level, topic). Questions are
+    # deduplicated by fingerprint; returns the number of questions added.
+    def add_bank_questions(self, language, level, topic, questions):
+        raise NotImplementedError
+
+    # {topic: number of banked questions}
+    def count_bank_questions(self, language, level, topics):
+        raise NotImplementedError
+
+    def sample_bank_questions(self, language, level, topic, count):
+        raise NotImplementedError
+
+    # (text with options, topic) of the newest limit banked questions across all topics, oldest first
+    def load_bank_question_texts(self, language, level, limit):
+        raise NotImplementedError
+
+    # Distinct topics with banked questions, at most limit of them
+    def load_bank_topics(self, language, level, limit):
+        raise NotImplementedError
+
+    # Distinct study plan topics of all users' courses, at most limit of them
+    def load_course_topics(self, language, level, limit):
+        raise NotImplementedError
+
+    # Add answered questions to a user's per-topic tally
+    def record_topic_answers(self, user, language, topic, correct, answered):
+        raise NotImplementedError
+
+    # {topic: (correct, answered)}
+    def load_topic_mastery(self, user, language):
+        raise NotImplementedError
+
+    def add_points(self, user, points):
+        raise NotImplementedError
+
+    def load_points(self, user):
+        raise NotImplementedError
+
+    # Apply a batch of buffered writes (see WriteBehindBuffer) in one transaction.
+    # Batches are applied at most once; returns False if batch_id was already applied.
+    def apply_write_batch(self, batch_id, ops):
+        raise NotImplementedError
+
+# Default storage backend: a single SQLite database in WAL mode, so several
+# Streamlit workers can read while one writes. Each thread gets its own connection.
+class SQLiteStorage(StorageBackend):
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user TEXT PRIMARY KEY,
+        password_hash TEXT NOT NULL,
+        salt TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS courses (
+        user TEXT NOT NULL,
+        language TEXT NOT NULL,
+        study_plan TEXT NOT NULL,
+        start_date TEXT,
+        current_day INTEGER NOT NULL,
+        max_day INTEGER NOT NULL,
+        level TEXT,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (user, language)
+    );
+    CREATE TABLE IF NOT EXISTS progress (
+        user TEXT NOT NULL,
+        language TEXT NOT NULL,
+        day INTEGER NOT NULL,
+        completed_at REAL NOT NULL,
+        PRIMARY KEY (user, language, day)
+    );
+    CREATE TABLE IF NOT EXISTS tests (
+        user TEXT NOT NULL,
+        language TEXT NOT NULL,
+        number INTEGER NOT NULL,
+        score INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (user, language, number)
+    );
+    CREATE TABLE IF NOT EXISTS flashcards (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        language TEXT NOT NULL,
+        front TEXT NOT NULL,
+        back TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        ease REAL NOT NULL DEFAULT 2.5,
+        interval REAL NOT NULL DEFAULT 0,
+        reps INTEGER NOT NULL DEFAULT 0,
+        due INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS question_bank (
+        language TEXT NOT NULL,
+        level TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        data TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (language, level, topic, fingerprint)
+    );
+    CREATE TABLE IF NOT EXISTS topic_mastery (
+        user TEXT NOT NULL,
+        language TEXT NOT NULL,
+        topic TEXT NOT NULL,
+        correct INTEGER NOT NULL,
+        answered INTEGER NOT NULL,
+        updated_at REAL NOT NULL,
+        PRIMARY KEY (user, language, topic)
+    );
+    CREATE TABLE IF NOT EXISTS points (
+        user TEXT PRIMARY KEY,
+        points INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS write_batches (
+        id TEXT PRIMARY KEY,
+        applied_at REAL NOT NULL
+    );
     """
-    response = query_gemini_api(prompt, api_key)
-    return response.strip()
+    # Columns added after a table was first released: (table, column, definition)
+    MIGRATIONS = [
+        ("flashcards", "ease", "REAL NOT NULL DEFAULT 2.5"),
+        ("flashcards", "interval", "REAL NOT NULL DEFAULT 0"),
+        ("flashcards", "reps", "INTEGER NOT NULL DEFAULT 0"),
+        ("flashcards", "due", "INTEGER NOT NULL DEFAULT 0"),
+    ]
+    INDEXES = """
+    CREATE INDEX IF NOT EXISTS flashcards_user_language_due ON flashcards (user, language, due);
+    DROP INDEX IF EXISTS flashcards_user_language;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connection()
+        conn.executescript(self.SCHEMA)
+        for table, column, definition in self.MIGRATIONS:
+            columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        conn.executescript(self.INDEXES)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self._connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    @staticmethod
+    def _course_from_row(row):
+        return {
+            "study_plan": json.loads(row["study_plan"]),
+            "start_date": row["start_date"],
+            "current_day": row["current_day"],
+            "max_day": row["max_day"],
+            "level": row["level"],
+        }
+
+    def create_user(self, user, password_hash, salt):
+        with self.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users (user, password_hash, salt, created_at) VALUES (?, ?, ?, ?)",
+                (user, password_hash, salt, time.time()),
+            )
+            return cursor.rowcount == 1
+
+    def load_user(self, user):
+        row = self._connection().execute(
+            "SELECT password_hash, salt FROM users WHERE user = ?", (user,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def has_users(self):
+        return self._connection().execute("SELECT 1 FROM users LIMIT 1").fetchone() is not None
+
+    def save_course(self, user, language, data):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO courses (user, language, study_plan, start_date, current_day, max_day, level, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (user, language, json.dumps(data["study_plan"]), data.get("start_date"), data["current_day"],
+                 data["max_day"], data.get("level"), time.time()),
+            )
+
+    def update_course_day(self, user, language, current_day):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE courses SET current_day = ?, updated_at = ? WHERE user = ? AND language = ?",
+                (current_day, time.time(), user, language),
+            )
+
+    def load_course(self, user, language):
+        row = self._connection().execute(
+            "SELECT * FROM courses WHERE user = ? AND language = ?", (user, language)
+        ).fetchone()
+        return self._course_from_row(row) if row else None
+
+    def load_courses(self, user):
+        rows = self._connection().execute(
+            "SELECT * FROM courses WHERE user = ? ORDER BY language", (user,)
+        ).fetchall()
+        return {row["language"]: self._course_from_row(row) for row in rows}
+
+    def load_course_summaries(self, user):
+        rows = self._connection().execute(
+            "SELECT language, start_date, current_day, max_day, level, json_array_length(study_plan) AS plan_length "
+            "FROM courses WHERE user = ? ORDER BY language",
+            (user,),
+        ).fetchall()
+        return {row["language"]: {key: row[key] for key in ("start_date", "current_day", "max_day", "level", "plan_length")}
+                for row in rows}
+
+    def load_study_plan(self, user, language):
+        row = self._connection().execute(
+            "SELECT study_plan FROM courses WHERE user = ? AND language = ?", (user, language)
+        ).fetchone()
+        return json.loads(row["study_plan"]) if row else None
+
+    def load_study_plan_page(self, user, language, start, count):
+        rows = self._connection().execute(
+            "SELECT day.value AS topic FROM courses, json_each(courses.study_plan) AS day "
+            "WHERE user = ? AND language = ? AND day.key >= ? ORDER BY day.key LIMIT ?",
+            (user, language, start, count),
+        ).fetchall()
+        return [row["topic"] for row in rows]
+
+    def add_progress_day(self, user, language, day):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO progress (user, language, day, completed_at) VALUES (?, ?, ?, ?)",
+                (user, language, day, time.time()),
+            )
+
+    def save_progress(self, user, language, days):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM progress WHERE user = ? AND language = ?", (user, language))
+            now = time.time()
+            conn.executemany(
+                "INSERT INTO progress (user, language, day, completed_at) VALUES (?, ?, ?, ?)",
+                [(user, language, day, now) for day in days],
+            )
+
+    def load_progress(self, user, language):
+        rows = self._connection().execute(
+            "SELECT day FROM progress WHERE user = ? AND language = ?", (user, language)
+        ).fetchall()
+        return {row["day"] for row in rows}
+
+    def save_test(self, user, language, test):
+        data = {"questions": test["questions"], "user_answers": test["user_answers"]}
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO tests (user, language, number, score, data, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (user, language, test["number"], test["score"], json.dumps(data), time.time()),
+            )
+
+    @staticmethod
+    def _test_from_row(row):
+        data = json.loads(row["data"])
+        return {
+            "number": row["number"],
+            "questions": data["questions"],
+            # JSON object keys are strings; answers are indexed by question number
+            "user_answers": {int(index): answer for index, answer in data["user_answers"].items()},
+            "score": row["score"],
+        }
+
+    def load_tests(self, user, language):
+        rows = self._connection().execute(
+            "SELECT number, score, data FROM tests WHERE user = ? AND language = ? ORDER BY number", (user, language)
+        ).fetchall()
+        return [self._test_from_row(row) for row in rows]
+
+    def load_test(self, user, language, number):
+        row = self._connection().execute(
+            "SELECT number, score, data FROM tests WHERE user = ? AND language = ? AND number = ?",
+            (user, language, number),
+        ).fetchone()
+        return self._test_from_row(row) if row else None
+
+    def load_test_summaries(self, user):
+        rows = self._connection().execute(
+            "SELECT language, number, score FROM tests WHERE user = ? ORDER BY language, number", (user,)
+        ).fetchall()
+        summaries = {}
+        for row in rows:
+            summaries.setdefault(row["language"], []).append({"number": row["number"], "score": row["score"]})
+        return summaries
+
+    def add_flashcards(self, user, language, flashcards):
+        ids = []
+        with self.transaction() as conn:
+            now = time.time()
+            for card in flashcards:
+                cursor = conn.execute(
+                    "INSERT INTO flashcards (user, language, front, back, created_at, ease, interval, reps, due) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (user, language, card["front"], card.get("back", ""), now, card.get("ease", FLASHCARD_INITIAL_EASE),
+                     card.get("interval", 0), card.get("reps", 0), int(card.get("due", now))),
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def load_due_flashcards(self, user, language, limit):
+        rows = self._connection().execute(
+            "SELECT id, ease, interval, reps, due FROM flashcards WHERE user = ? AND language = ? "
+            "ORDER BY due, id LIMIT ?",
+            (user, language, limit),
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def load_flashcard_text(self, card_id):
+        row = self._connection().execute("SELECT front, back FROM flashcards WHERE id = ?", (card_id,)).fetchone()
+        return (row["front"], row["back"]) if row else ("", "")
+
+    def load_flashcard_languages(self, user):
+        rows = self._connection().execute(
+            "SELECT DISTINCT language FROM flashcards WHERE user = ? ORDER BY language", (user,)
+        ).fetchall()
+        return [row["language"] for row in rows]
+
+    def load_flashcard_fronts(self, user, language, limit):
+        rows = self._connection().execute(
+            "SELECT front FROM flashcards WHERE user = ? AND language = ? ORDER BY id DESC LIMIT ?", (user, language, limit)
+        ).fetchall()
+        return [row["front"] for row in reversed(rows)]
+
+    def update_flashcard_schedule(self, card_id, ease, interval, reps, due):
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE flashcards SET ease = ?, interval = ?, reps = ?, due = ? WHERE id = ?",
+                (ease, interval, reps, int(due), card_id),
+            )
+
+    def add_bank_questions(self, language, level, topic, questions):
+        with self.transaction() as conn:
+            now = time.time()
+            added = 0
+            for question in questions:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO question_bank (language, level, topic, fingerprint, data, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (language, level, topic, text_fingerprint(question_text(question)), json.dumps(question), now),
+                )
+                added += cursor.rowcount
+            return added
+
+    def count_bank_questions(self, language, level, topics):
+        topics = list(topics)
+        rows = self._connection().execute(
+            f"SELECT topic, COUNT(*) AS n FROM question_bank WHERE language = ? AND level = ? "
+            f"AND topic IN ({', '.join('?' * len(topics))}) GROUP BY topic",
+            (language, level, *topics),
+        ).fetchall()
+        return {row["topic"]: row["n"] for row in rows}
+
+    def sample_bank_questions(self, language, level, topic, count):
+        rows = self._connection().execute(
+            "SELECT data FROM question_bank WHERE language = ? AND level = ? AND topic = ? ORDER BY RANDOM() LIMIT ?",
+            (language, level, topic, count),
+        ).fetchall()
+        return [json.loads(row["data"]) for row in rows]
+
+    def load_bank_question_texts(self, language, level, limit):
+        rows = self._connection().execute(
+            "SELECT topic, data FROM question_bank WHERE language = ? AND level = ? ORDER BY created_at DESC LIMIT ?",
+            (language, level, limit),
+        ).fetchall()
+        return [(question_text(json.loads(row["data"])), row["topic"]) for row in reversed(rows)]
+
+    def load_bank_topics(self, language, level, limit):
+        rows = self._connection().execute(
+            "SELECT DISTINCT topic FROM question_bank WHERE language = ? AND level = ? LIMIT ?",
+            (language, level, limit),
+        ).fetchall()
+        return [row["topic"] for row in rows]
+
+    def load_course_topics(self, language, level, limit):
+        rows = self._connection().execute(
+            "SELECT DISTINCT day.value AS topic FROM courses, json_each(courses.study_plan) AS day "
+            "WHERE language = ? AND COALESCE(level, '') = ? LIMIT ?",
+            (language, level, limit),
+        ).fetchall()
+        return [row["topic"] for row in rows]
+
+    def record_topic_answers(self, user, language, topic, correct, answered):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO topic_mastery (user, language, topic, correct, answered, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (user, language, topic) DO UPDATE SET correct = correct + excluded.correct, "
+                "answered = answered + excluded.answered, updated_at = excluded.updated_at",
+                (user, language, topic, correct, answered, time.time()),
+            )
+
+    def load_topic_mastery(self, user, language):
+        rows = self._connection().execute(
+            "SELECT topic, correct, answered FROM topic_mastery WHERE user = ? AND language = ?", (user, language)
+        ).fetchall()
+        return {row["topic"]: (row["correct"], row["answered"]) for row in rows}
+
+    def add_points(self, user, points):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO points (user, points) VALUES (?, ?) "
+                "ON CONFLICT (user) DO UPDATE SET points = points + excluded.points",
+                (user, points),
+            )
+
+    def load_points(self, user):
+        row = self._connection().execute("SELECT points FROM points WHERE user = ?", (user,)).fetchone()
+        return row["points"] if row else 0
+
+    def apply_write_batch(self, batch_id, ops):
+        with self.transaction() as conn:
+            now = time.time()
+            cursor = conn.execute("INSERT OR IGNORE INTO write_batches (id, applied_at) VALUES (?, ?)", (batch_id, now))
+            if cursor.rowcount == 0:
+                return False
+            # Only the journal of an interrupted flush is ever replayed, so old ids can go
+            conn.execute("DELETE FROM write_batches WHERE applied_at < ?", (now - 7 * 86400,))
+            for op in ops:
+                if op["op"] == "course_day":
+                    self.update_course_day(op["user"], op["language"], op["current_day"])
+                elif op["op"] == "progress":
+                    for day in op["days"]:
+                        self.add_progress_day(op["user"], op["language"], day)
+                elif op["op"] == "points":
+                    self.add_points(op["user"], op["points"])
+                elif op["op"] == "test":
+                    self.save_test(op["user"], op["language"], op["test"])
+                elif op["op"] == "card_review":
+                    self.update_flashcard_schedule(op["card_id"], op["ease"], op["interval"], op["reps"], op["due"])
+                elif op["op"] == "mastery":
+                    self.record_topic_answers(op["user"], op["language"], op["topic"], op["correct"], op["answered"])
+                else:
+                    raise ValueError(f"Unknown write operation: {op['op']}")
+            return True
+
+STORAGE_BACKENDS = {
+    "sqlite": SQLiteStorage,
+}
+
+# Shared by all sessions and workers of this Streamlit process
+@st.cache_resource
+def get_storage():
+    if STORAGE_BACKEND not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend: {STORAGE_BACKEND}")
+    return STORAGE_BACKENDS[STORAGE_BACKEND](STORAGE_PATH)
+
+# Write-behind buffer for small, frequent writes: course day changes, completed
+# days, points, test answers, topic mastery and flashcard reviews. Writes are
+# merged per key in memory and flushed to storage in one transaction every
+# WRITE_BEHIND_INTERVAL seconds, on logout and at exit. Each batch is journaled
+# first (written to a temp file, then atomically renamed), so a flush interrupted
+# by a crash is replayed on the next start; the backend skips batches it has
+# already applied.
+class WriteBehindBuffer:
+    def __init__(self, storage, journal_prefix, interval=WRITE_BEHIND_INTERVAL, max_pending=WRITE_BEHIND_MAX_PENDING):
+        self.storage = storage
+        self.journal_prefix = journal_prefix
+        # One journal per process, several Streamlit processes may share the database
+        self.journal_path = f"{journal_prefix}-{os.getpid()}"
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._unapplied = None  # (batch id, ops) journaled by a flush that failed to apply them
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self.writes = 0
+        self.flushes = 0
+        self.ops_flushed = 0
+        self.replayed = 0
+        self.replay_journals()
+        threading.Thread(target=self._flush_loop, name="write-behind", daemon=True).start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _merge(old, new):
+        if new["op"] == "progress":
+            return {**new, "days": sorted(set(old["days"]) | set(new["days"]))}
+        if new["op"] == "points":
+            return {**new, "points": old["points"] + new["points"]}
+        if new["op"] == "mastery":
+            return {**new, "correct": old["correct"] + new["correct"], "answered": old["answered"] + new["answered"]}
+        return new
+
+    def _add(self, key, op):
+        with self._lock:
+            previous = self._pending.get(key)
+            self._pending[key] = self._merge(previous, op) if previous else op
+            self.writes += 1
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self._wakeup.set()
+
+    def set_course_day(self, user, language, current_day):
+        self._add(("course_day", user, language),
+                  {"op": "course_day", "user": user, "language": language, "current_day": current_day})
+
+    def add_progress_day(self, user, language, day):
+        self._add(("progress", user, language), {"op": "progress", "user": user, "language": language, "days": [day]})
+
+    def add_points(self, user, points):
+        self._add(("points", user), {"op": "points", "user": user, "points": points})
+
+    def record_answer(self, user, language, topic, correct):
+        self._add(("mastery", user, language, topic), {"op": "mastery", "user": user, "language": language, "topic": topic,
+                                                       "correct": int(correct), "answered": 1})
+
+    def review_card(self, card):
+        self._add(("card_review", card["id"]), {"op": "card_review", "card_id": card["id"], "ease": card["ease"],
+                                                "interval": card["interval"], "reps": card["reps"], "due": card["due"]})
+
+    def save_test(self, user, language, test):
+        # Snapshot the test, the session keeps mutating its own copy
+        snapshot = json.loads(json.dumps(test))
+        self._add(("test", user, language, test["number"]),
+                  {"op": "test", "user": user, "language": language, "test": snapshot})
+
+    def pending_count(self):
+        unapplied = self._unapplied
+        with self._lock:
+            return len(self._pending) + (len(unapplied[1]) if unapplied else 0)
+
+    def _write_journal(self, batch_id, ops):
+        tmp_path = f"{self.journal_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"id": batch_id, "ops": ops}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def _remove_journal(self, path):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+    # Apply journals left behind by flushes that never completed, including those
+    # of other processes; applying a batch twice is a no-op
+    def replay_journals(self):
+        directory = os.path.dirname(os.path.abspath(self.journal_prefix))
+        prefix = os.path.basename(self.journal_prefix) + "-"
+        for name in sorted(os.listdir(directory)):
+            if not name.startswith(prefix):
+                continue
+            path = os.path.join(directory, name)
+            if name.endswith(".tmp"):
+                # Never renamed into place, so its batch was never applied either
+                self._remove_journal(path)
+                continue
+            try:
+                with open(path, encoding="utf-8") as f:
+                    journal = json.load(f)
+            except FileNotFoundError:
+                continue
+            if self.storage.apply_write_batch(journal["id"], journal["ops"]):
+                self.replayed += 1
+            self._remove_journal(path)
+
+    # Write everything buffered so far; returns the number of operations written.
+    # A batch that was journaled but failed to apply is retried first under the
+    # same id, never merged back into the buffer: another process may replay its
+    # journal meanwhile, and the id is what keeps it from being applied twice.
+    def flush(self):
+        with self._flush_lock:
+            written = 0
+            if self._unapplied is not None:
+                written += self._apply(*self._unapplied)
+            with self._lock:
+                if not self._pending:
+                    return written
+                batch, self._pending = self._pending, {}
+            batch_id = uuid.uuid4().hex
+            ops = list(batch.values())
+            try:
+                self._write_journal(batch_id, ops)
+            except Exception:
+                # Nothing was journaled: put the batch back underneath newer writes
+                with self._lock:
+                    for key, op in batch.items():
+                        newer = self._pending.get(key)
+                        self._pending[key] = self._merge(op, newer) if newer else op
+                raise
+            self._unapplied = (batch_id, ops)
+            return written + self._apply(batch_id, ops)
+
+    # Apply the journaled batch; caller holds the flush lock
+    def _apply(self, batch_id, ops):
+        self.storage.apply_write_batch(batch_id, ops)
+        self._unapplied = None
+        self._remove_journal(self.journal_path)
+        self.flushes += 1
+        self.ops_flushed += len(ops)
+        return len(ops)
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass  # the batch stays journaled and is retried by the next flush
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self.flush()
+
+@st.cache_resource
+def get_write_behind():
+    return WriteBehindBuffer(get_storage(), f"{STORAGE_PATH}.journal")
+
+# Write out buffered writes, before logout or before reading what they touch
+def flush_writes():
+    get_write_behind().flush()
+
+def current_user():
+    return st.session_state.get('username', DEFAULT_USER)
+
+# Session-state records. A course keeps its metadata and one page of the study
+# plan around the current day; tests are kept as summaries and only the open test
+# is held in full. Topics are interned so sessions on the same plan share them.
+class CourseState:
+    __slots__ = ("start_date", "current_day", "max_day", "level", "plan_length", "page_start", "page")
+
+    def __init__(self, start_date, current_day, max_day, level, plan_length, page_start=0, page=()):
+        self.start_date = start_date
+        self.current_day = current_day
+        self.max_day = max_day
+        self.level = level
+        self.plan_length = plan_length
+        self.page_start = page_start
+        self.page = page
+
+class TestSummary:
+    __slots__ = ("number", "score")
+
+    def __init__(self, number, score):
+        self.number = number
+        self.score = score
+
+# Load the logged-in user's course summaries, test list and points. Study plans,
+# test questions and flashcards are only loaded when they are opened.
+def load_user_state():
+    flush_writes()
+    storage = get_storage()
+    user = current_user()
+    st.session_state.conversations = {language: CourseState(**summary)
+                                      for language, summary in storage.load_course_summaries(user).items()}
+    st.session_state.tests = {language: [TestSummary(test['number'], test['score']) for test in tests]
+                              for language, tests in storage.load_test_summaries(user).items()}
+    st.session_state.open_test_data = None
+    # Languages with a deck; cards are read through get_due_queue
+    st.session_state.flashcards = {language: None for language in storage.load_flashcard_languages(user)}
+    st.session_state.due_queues = {}
+    st.session_state.mastery = {}
+    st.session_state.user_points = storage.load_points(user)
+    st.session_state.loaded_user = user
+
+def get_course(language):
+    return st.session_state.conversations[language]
+
+# Topics of up to count days starting at first_day (1-based). Pages in
+# STUDY_PLAN_PAGE_DAYS days from storage when the range is outside the cached page.
+def course_topics(language, first_day, count):
+    course = get_course(language)
+    start = max(0, first_day - 1)
+    end = min(start + count, course.plan_length)
+    if start >= end:
+        return []
+    if start < course.page_start or end > course.page_start + len(course.page):
+        # Page in the days around the requested range: a few before it for
+        # Previous Day and the rest after it, so Next Day and prefetching stay
+        # inside the page
+        page_start = max(0, min(start - STUDY_PLAN_PAGE_DAYS // 4, course.plan_length - STUDY_PLAN_PAGE_DAYS))
+        page = get_storage().load_study_plan_page(current_user(), language, page_start,
+                                                  max(STUDY_PLAN_PAGE_DAYS, end - page_start))
+        course.page_start = page_start
+        course.page = tuple(sys.intern(topic) for topic in page)
+    return list(course.page[start - course.page_start:end - course.page_start])
+
+def course_topic(language, day):
+    topics = course_topics(language, day, 1)
+    return topics[0] if topics else None
+
+# Only the open test is held in full; selecting another test pages it in from
+# storage and drops the previous one
+def get_test(language, test_number):
+    loaded = st.session_state.get('open_test_data')
+    if loaded is not None and loaded[0] == language and loaded[1]['number'] == test_number:
+        return loaded[1]
+    flush_writes()  # answers to this test may still be buffered
+    test = get_storage().load_test(current_user(), language, test_number)
+    st.session_state.open_test_data = (language, test) if test else None
+    return test
+
+# Per-topic (correct, answered) tallies of the user's test answers, loaded once per course
+def get_mastery(language):
+    mastery = st.session_state.mastery.get(language)
+    if mastery is None:
+        flush_writes()  # answers may still be buffered
+        mastery = st.session_state.mastery[language] = get_storage().load_topic_mastery(current_user(), language)
+    return mastery
+
+# Count one answered question toward its topic, in the session and through the
+# write-behind buffer
+def record_topic_answer(language, topic, correct):
+    mastery = get_mastery(language)
+    right, answered = mastery.get(topic, (0, 0))
+    mastery[topic] = (right + int(correct), answered + 1)
+    get_write_behind().record_answer(current_user(), language, topic, correct)
+
+# Laplace-smoothed accuracy of a (correct, answered) tally; an untested topic is 0.5
+def topic_accuracy(tally):
+    correct, answered = tally
+    return (correct + 1) / (answered + 2)
 
 # Function to save the study plan and session data
 def save_session_data(language, data):
-    with open(f"{language}_session.json", "w") as f:
-        json.dump(data, f)
+    flush_writes()
+    get_storage().save_course(current_user(), language, data)
+
+# Persist only the current day of a course, through the write-behind buffer
+def save_course_day(language, current_day):
+    get_write_behind().set_course_day(current_user(), language, current_day)
+
+# Persist a test's answers and score, through the write-behind buffer
+def save_test_answers(language, test):
+    get_write_behind().save_test(current_user(), language, test)
+    for summary in st.session_state.tests.get(language, []):
+        if summary.number == test['number']:
+            summary.score = test['score']
 
 # Function to load the study plan and session data
 def load_session_data(language):
-    if os.path.exists(f"{language}_session.json"):
-        with open(f"{language}_session.json", "r") as f:
-            return json.load(f)
-    return None
+    flush_writes()
+    return get_storage().load_course(current_user(), language)
 
 # Load all session data on startup
 def load_all_sessions():
-    sessions = {}
-    for file in os.listdir():
-        if file.endswith("_session.json"):
-            language = file.replace("_session.json", "")
-            sessions[language] = load_session_data(language)
-    return sessions
+    flush_writes()
+    return get_storage().load_courses(current_user())
 
-# Function to generate test questions
+# Split count items over the topics as evenly as possible, earlier topics first
+def split_count(count, topics):
+    base, extra = divmod(count, len(topics))
+    return {topic: base + (1 if index < extra else 0) for index, topic in enumerate(topics)}
+
+# Split count items over {topic: weight} in proportion to the weights; leftover
+# items go to the largest remainders, earlier topics first on ties
+def weighted_split(count, weights):
+    total = sum(weights.values())
+    if not total:
+        return split_count(count, list(weights))
+    shares = {topic: count * weight / total for topic, weight in weights.items()}
+    quotas = {topic: int(share) for topic, share in shares.items()}
+    for topic in sorted(shares, key=lambda topic: quotas[topic] - shares[topic])[:count - sum(quotas.values())]:
+        quotas[topic] += 1
+    return quotas
+
+# Questions per topic for a new test: the recent topics plus the weakest earlier
+# topics, weighted by how often the user gets each one wrong. Well-mastered topics
+# can end up with no questions, which also saves generating questions for them.
+def plan_test_topics(recent_topics, mastery, count=TEST_QUESTION_COUNT):
+    weak = sorted((topic for topic, tally in mastery.items()
+                   if topic not in recent_topics and topic_accuracy(tally) < MASTERY_REVIEW_THRESHOLD),
+                  key=lambda topic: topic_accuracy(mastery[topic]))
+    topics = list(recent_topics) + weak[:MASTERY_REVIEW_TOPICS]
+    quotas = weighted_split(count, {topic: 1 - topic_accuracy(mastery.get(topic, (0, 0))) for topic in topics})
+    return {topic: quota for topic, quota in quotas.items() if quota}
+
+# Asyncio generation engine: requests items for every topic concurrently,
+# validates each batch as it arrives and re-requests only the shortfall for
+# that topic, so the total time is bounded by the slowest topic. Items are
+# tagged with the topic they were generated for. count is either a total spread
+# evenly over the topics or a {topic: count} dict.
+async def generate_items_for_topics(build_prompt, parse, topics, count, api_key, priority=PRIORITY_INTERACTIVE, index=None,
+                                    operation="other"):
+    quotas = count if isinstance(count, dict) else split_count(count, topics)
+
+    async def fill(topic):
+        items = []
+        seen = set()
+        for _ in range(GENERATION_MAX_ROUNDS):
+            shortfall = quotas[topic] - len(items)
+            if shortfall <= 0:
+                break
+            try:
+                response = await asyncio.wrap_future(
+                    submit_gemini_request(build_prompt(topic, shortfall), api_key, priority, operation=operation,
+                                          generation_config=generation_config(operation, shortfall)))
+            except ValueError:
+                continue
+            for item in parse(response):
+                raw_text = question_text(item) if 'question' in item else item.get('front', '')
+                text = " ".join(raw_text.split()).casefold()
+                if text in seen or len(items) >= quotas[topic]:
+                    continue
+                # Items already in the deck or bank don't count toward the quota
+                if index is not None and index.find_duplicate(raw_text, topic):
+                    continue
+                seen.add(text)
+                item['topic'] = sys.intern(topic)
+                items.append(item)
+        return items
 
-def generate_test_questions(language, topics, api_key):
-    prompt = f"""
-    Generate 10 multiple-choice questions to test understanding of the following topics in {language}: {', '.join(topics)}. 
+    batches = await asyncio.gather(*(fill(topic) for topic in topics if quotas[topic]))
+    return [item for batch in batches for item in batch]
+
+def run_generation(build_prompt, parse, topics, count, api_key, priority=PRIORITY_INTERACTIVE, index=None, operation="other"):
+    if not topics:
+        return []
+    return asyncio.run(generate_items_for_topics(build_prompt, parse, topics, count, api_key, priority, index, operation))
+
+# Function to generate test questions
+@timed("test_questions")
+def generate_test_questions(language, topics, api_key, count=TEST_QUESTION_COUNT, level=None, index=None):
+    level_text = f" at {prompt_value(level)} level" if level else ""
+    def build_prompt(topic, question_count):
+        return budget_prompt("test_questions", f"""
+    Generate {question_count} multiple-choice questions to test understanding of '{prompt_value(topic)}' in {prompt_value(language)}{level_text}.
     Format each question as follows:
 
     Q: [question]
@@ -130,38 +2911,326 @@ def generate_test_questions(language, topics, api_key):
     Correct: [letter]
     Explanation: [brief explanation of the correct answer]
 
-    Ensure questions cover a range of difficulty levels and aspects of the topics.
-    """
-    response = query_gemini_api(prompt, api_key)
-    return parse_test_questions(response)
+    Ensure questions cover a range of difficulty levels and aspects of the topic.
+    """)
+    return run_generation(build_prompt, parse_test_questions, topics, count, api_key, index=index, operation="test_questions")
+
+# Labelled lines in model output, e.g. "Q: ...", "**Back:** ...", "3. Front: ..."
+FIELD_LINE_RE = re.compile(
+    r'^(?:\d+[.)]\s+)?(?:\*\*)?(?P<label>Q|Question(?:\s+\d+)?|Correct(?:\s+answer)?|Explanation|Front|Back)\s*:(?:\*\*)?\s*(?P<value>.*)$',
+    re.IGNORECASE)
+OPTION_LINE_RE = re.compile(r'^(?:\*\*)?(?P<letter>[A-D])[).](?:\*\*)?\s+(?P<value>.*)$')
+
+# A problem found while parsing model output. Items with "error" diagnostics are
+# dropped; "warning" diagnostics describe items that were repaired and kept.
+class ParseDiagnostic:
+    def __init__(self, line_number, severity, code, message):
+        self.line_number = line_number
+        self.severity = severity
+        self.code = code
+        self.message = message
+
+    def __repr__(self):
+        return f"ParseDiagnostic(line={self.line_number}, {self.severity}, {self.code}: {self.message})"
+
+# Single-pass incremental parser for labelled blocks in model output. feed()
+# takes text chunks as they stream in and yields each item as soon as it is
+# complete and valid; close() flushes the last one. Unlabelled lines continue
+# the previous field, so multi-line values and fenced code blocks are kept.
+class StreamingBlockParser:
+    kind = "block"
+
+    def __init__(self):
+        self.diagnostics = []
+        self.accepted = 0
+        self.rejected = 0
+        self._pending = ""
+        self._line_number = 0
+        self._in_fence = False
+        self._item = None
+        self._item_line = 0
+        self._field = None
+        self._blank_pending = False
+
+    def feed(self, chunk):
+        self._pending += chunk
+        *lines, self._pending = self._pending.split('\n')
+        for line in lines:
+            yield from self._feed_line(line)
+
+    def close(self):
+        if self._pending:
+            line, self._pending = self._pending, ""
+            yield from self._feed_line(line)
+        yield from self._complete()
+
+    def parse(self, text):
+        return list(self.feed(text)) + list(self.close())
+
+    def _feed_line(self, raw_line):
+        self._line_number += 1
+        line = raw_line.strip()
+        if line.startswith('```'):
+            self._in_fence = not self._in_fence
+            self._continue_field(raw_line.rstrip())
+        elif self._in_fence:
+            self._continue_field(raw_line.rstrip())
+        elif not line:
+            self._blank_pending = self._item is not None
+            yield from self._blank_line()
+        else:
+            yield from self._handle_line(line)
+
+    def _start_item(self, item, field):
+        self._item = item
+        self._item_line = self._line_number
+        self._field = field
+        self._blank_pending = False
+
+    def _set_field(self, field, value):
+        self._item[field] = value
+        self._field = field
+        self._blank_pending = False
+
+    def _continue_field(self, text):
+        if self._item is None or self._field is None:
+            return
+        current = self._item[self._field] or ""
+        separator = '\n\n' if self._blank_pending else '\n'
+        self._item[self._field] = f"{current}{separator}{text}" if current else text
+        self._blank_pending = False
+
+    def _diagnose(self, severity, code, message, line_number=None):
+        self.diagnostics.append(ParseDiagnostic(line_number or self._line_number, severity, code, message))
+
+    def _complete(self):
+        if self._item is None:
+            return
+        item, self._item, self._field = self._item, None, None
+        result = self._validate(item)
+        if result is None:
+            self.rejected += 1
+        else:
+            self.accepted += 1
+            yield result
+
+    def _blank_line(self):
+        return iter(())
+
+    def _handle_line(self, line):
+        raise NotImplementedError
+
+    def _validate(self, item):
+        raise NotImplementedError
+
+class QuestionStreamParser(StreamingBlockParser):
+    kind = "test_questions"
+
+    # A question is complete at the blank line after its explanation
+    def _blank_line(self):
+        if self._item is not None and self._item['explanation'] is not None:
+            yield from self._complete()
+
+    def _handle_line(self, line):
+        match = FIELD_LINE_RE.match(line)
+        label = match.group('label').lower() if match else None
+        value = match.group('value').strip() if match else None
+        option = OPTION_LINE_RE.match(line)
+        if label and (label == 'q' or label.startswith('question')):
+            yield from self._complete()
+            self._start_item({'question': value, 'options': {}, 'correct': None, 'explanation': None}, 'question')
+        elif option:
+            letter = option.group('letter')
+            if self._item is None:
+                self._diagnose("warning", "orphan_option", f"Option {letter} appears before any question")
+                return
+            if letter in self._item['options']:
+                self._diagnose("warning", "duplicate_option", f"Option {letter} is given twice; keeping the first")
+                self._field = None
+                return
+            self._item['options'][letter] = option.group('value').strip()
+            self._field = letter
+        elif label and label.startswith('correct'):
+            if self._item is None:
+                self._diagnose("warning", "orphan_field", "Correct answer appears before any question")
+                return
+            letter = re.match(r'^[(\s*]*([A-Da-d])\b', value)
+            if letter is None:
+                self._diagnose("error", "invalid_correct", f"Correct answer {value!r} is not one of A-D", self._item_line)
+            self._item['correct'] = letter.group(1).upper() if letter else ""
+            self._field = None
+        elif label == 'explanation':
+            if self._item is None:
+                self._diagnose("warning", "orphan_field", "Explanation appears before any question")
+                return
+            self._set_field('explanation', value)
+        else:
+            self._continue_field(line)
+
+    # Continuation lines after an option extend that option
+    def _continue_field(self, text):
+        if self._item is not None and self._field in ('A', 'B', 'C', 'D'):
+            options = self._item['options']
+            separator = '\n\n' if self._blank_pending else '\n'
+            options[self._field] = f"{options[self._field]}{separator}{text}"
+            self._blank_pending = False
+        else:
+            super()._continue_field(text)
+
+    def _validate(self, item):
+        if not item['question'].strip():
+            self._diagnose("error", "empty_question", "Question text is empty", self._item_line)
+            return None
+        missing = [letter for letter in 'ABCD' if not item['options'].get(letter)]
+        if missing:
+            self._diagnose("error", "missing_options", f"Question is missing option(s) {', '.join(missing)}", self._item_line)
+            return None
+        if not item['correct']:
+            if item['correct'] is None:
+                self._diagnose("error", "missing_correct", "Question has no correct answer", self._item_line)
+            return None
+        if item['explanation'] is None:
+            self._diagnose("warning", "missing_explanation", "Question has no explanation", self._item_line)
+        return {
+            'question': item['question'].strip(),
+            'options': [item['options'][letter].strip() for letter in 'ABCD'],
+            'correct': item['correct'],
+            'explanation': (item['explanation'] or "").strip(),
+        }
+
+class FlashcardStreamParser(StreamingBlockParser):
+    kind = "flashcards"
+
+    def _handle_line(self, line):
+        match = FIELD_LINE_RE.match(line)
+        label = match.group('label').lower() if match else None
+        if label == 'front':
+            yield from self._complete()
+            self._start_item({'front': match.group('value').strip(), 'back': None}, 'front')
+        elif label == 'back':
+            if self._item is None:
+                self._diagnose("warning", "orphan_field", "Back appears before any front")
+            elif self._item['back'] is not None:
+                self._diagnose("warning", "duplicate_back", "Card has two backs; keeping the first")
+                self._field = None
+            else:
+                self._set_field('back', match.group('value').strip())
+        else:
+            self._continue_field(line)
+
+    def _validate(self, item):
+        if not item['front'].strip():
+            self._diagnose("error", "empty_front", "Card front is empty", self._item_line)
+            return None
+        if not (item['back'] or "").strip():
+            self._diagnose("error", "missing_back", "Card has no back", self._item_line)
+            return None
+        return {'front': item['front'].strip(), 'back': item['back'].strip()}
+
+# Process-wide parse outcome counters, used to track parse failure rates
+class ParseStats:
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self.accepted = Counter()
+        self.rejected = Counter()
+        self.diagnostics = Counter()
+
+    def record(self, parser):
+        with self._lock:
+            self.accepted[parser.kind] += parser.accepted
+            self.rejected[parser.kind] += parser.rejected
+            for diagnostic in parser.diagnostics:
+                self.diagnostics[(parser.kind, diagnostic.code)] += 1
+        self.metrics.inc("parsed_items_total", parser.accepted, kind=parser.kind, outcome="accepted")
+        self.metrics.inc("parsed_items_total", parser.rejected, kind=parser.kind, outcome="rejected")
+        for diagnostic in parser.diagnostics:
+            self.metrics.inc("parse_diagnostics_total", kind=parser.kind, code=diagnostic.code)
+
+    def failure_rate(self, kind):
+        with self._lock:
+            total = self.accepted[kind] + self.rejected[kind]
+            return self.rejected[kind] / total if total else 0.0
+
+@st.cache_resource
+def get_parse_stats():
+    return ParseStats(get_metrics())
 
 def parse_test_questions(response):
+    parser = QuestionStreamParser()
+    questions = parser.parse(response)
+    get_parse_stats().record(parser)
+    return questions
+
+# Banked questions each topic needs: QUESTION_BANK_MIN_PER_TOPIC, or its quota in
+# quotas ({topic: count}) when a test asks for more
+def bank_needs(topics, quotas=None):
+    return {topic: max(QUESTION_BANK_MIN_PER_TOPIC, (quotas or {}).get(topic, 0)) for topic in topics}
+
+# Map each topic to the bank topic its questions come from: itself, or a
+# differently phrased topic of the same language and level that already has
+# the questions the topic needs when topic itself has fewer
+def resolve_bank_topics(language, level, topics, quotas=None):
+    storage = get_storage()
+    needed = bank_needs(topics, quotas)
+    banked = storage.count_bank_questions(language, level, topics)
+    index = get_bank_topic_index(language, level)
+    resolved = {}
+    for topic in topics:
+        resolved[topic] = topic
+        if banked.get(topic, 0) >= needed[topic]:
+            continue
+        similar = index.find(topic)
+        if similar:
+            counts = storage.count_bank_questions(language, level, similar)
+            resolved[topic] = next((other for other in similar if counts.get(other, 0) >= needed[topic]), topic)
+    return resolved
+
+# Generate questions for the topics that have fewer banked questions than they
+# need (see bank_needs), and no similar topic that has enough, and add them to
+# the shared question bank; returns the number of questions generated
+def fill_question_bank(language, level, topics, api_key, quotas=None):
+    storage = get_storage()
+    level = level or ""
+    needed = bank_needs(topics, quotas)
+    resolved = resolve_bank_topics(language, level, topics, quotas)
+    similar = sum(1 for topic in topics if resolved[topic] != topic)
+    own = [topic for topic in topics if resolved[topic] == topic]
+    banked = storage.count_bank_questions(language, level, own)
+    shortfall = {topic: needed[topic] - banked.get(topic, 0) for topic in own if banked.get(topic, 0) < needed[topic]}
+    get_metrics().inc("question_bank_topics_total", len(own) - len(shortfall), result="hit")
+    get_metrics().inc("question_bank_topics_total", similar, result="similar")
+    get_metrics().inc("question_bank_topics_total", len(shortfall), result="miss")
+    if shortfall and api_key:
+        index = get_question_index(language, level)
+        generated = generate_test_questions(language, list(shortfall), api_key, shortfall, level or None, index)
+        generated = [question for question in generated if index.add(question_text(question), question['topic'])]
+        topic_index = get_bank_topic_index(language, level)
+        with storage.transaction():
+            for topic in shortfall:
+                if storage.add_bank_questions(language, level, topic, [q for q in generated if q['topic'] == topic]):
+                    topic_index.add(topic)
+        return len(generated)
+    return 0
+
+# Assemble a test from the shared question bank. Questions are only generated
+# for topics that are short of banked questions; everything else is a local
+# lookup. count is either a total spread evenly over the topics or a
+# {topic: count} dict. Questions sampled for a similar topic are tagged with
+# the requested one, so mastery is tracked under the course's own topics.
+@timed("build_test")
+def build_test_questions(language, level, topics, api_key, count=TEST_QUESTION_COUNT):
+    storage = get_storage()
+    level = level or ""
+    quotas = count if isinstance(count, dict) else split_count(count, topics)
+    fill_question_bank(language, level, topics, api_key, quotas)
+    resolved = resolve_bank_topics(language, level, topics, quotas)
     questions = []
-    current_question = {}
-    for line in response.split('\n'):
-        line = line.strip()
-        if line.startswith('Q:'):
-            if current_question:
-                if 'options' in current_question and 'correct' in current_question:
-                    questions.append(current_question)
-                current_question = {'question': line[2:].strip(), 'options': []}
-        elif line.startswith(('A)', 'B)', 'C)', 'D)')):
-            current_question['options'].append(line[3:].strip())
-        elif line.startswith('Correct:'):
-            current_question['correct'] = line.split(':')[1].strip()
-        elif line.startswith('Explanation:'):
-            current_question['explanation'] = line.split(':', 1)[1].strip()
-    
-    if current_question and 'options' in current_question and 'correct' in current_question:
-        questions.append(current_question)
-    
-    # Validate and filter questions
-    valid_questions = []
-    for q in questions:
-        if len(q['options']) == 4 and q['correct'] in 'ABCD' and len(q['correct']) == 1:
-            valid_questions.append(q)
-    
-    return valid_questions
+    for topic in topics:
+        for question in storage.sample_bank_questions(language, level, resolved[topic], quotas[topic]):
+            question['topic'] = topic
+            questions.append(question)
+    return questions
 
 def create_new_test(language):
     st.subheader(f"Create New Test for {language}")
@@ -170,16 +3239,16 @@ def create_new_test(language):
         st.error(f"No course data found for {language}. Please create a course first.")
         return
 
-    session_data = st.session_state.conversations[language]
-    current_day = session_data.get('current_day', 1)
-    study_plan = session_data.get('study_plan', [])
+    course = get_course(language)
+    current_day = course.current_day
     
-    if not study_plan:
+    if not course.plan_length:
         st.error(f"No study plan found for {language}. Please recreate the course.")
         return
 
     # Retrieving recent topics based on current day
-    recent_topics = study_plan[max(0, current_day-3):current_day]
+    first_day = max(1, current_day - 2)
+    recent_topics = course_topics(language, first_day, current_day - first_day + 1)
     
     if not recent_topics:
         st.warning("Not enough topics covered yet to create a test. Please progress further in the course.")
@@ -187,10 +3256,13 @@ def create_new_test(language):
 
     with st.spinner("Generating test questions..."):
         try:
-            questions = generate_test_questions(language, recent_topics, st.session_state.gemini_api_key)
+            quotas = plan_test_topics(recent_topics, get_mastery(language))
+            questions = build_test_questions(language, course.level, list(quotas), st.session_state.gemini_api_key, quotas)
             if not questions:
                 st.error("Failed to generate valid questions. Please try again.")
                 return
+            if len(questions) < sum(quotas.values()):
+                st.warning(f"Only {len(questions)} of {sum(quotas.values())} questions could be generated for this test.")
             
             test_number = len(st.session_state.tests.get(language, [])) + 1
             new_test = {
@@ -199,44 +3271,38 @@ def create_new_test(language):
                 'user_answers': {},
                 'score': 0
             }
+            get_storage().save_test(current_user(), language, new_test)
             if language not in st.session_state.tests:
                 st.session_state.tests[language] = []
-            st.session_state.tests[language].append(new_test)
+            st.session_state.tests[language].append(TestSummary(test_number, 0))
+            st.session_state.open_test_data = (language, new_test)
             st.success(f"Test {test_number} for {language} created successfully!")
             st.session_state.new_test = None
-            st.session_state.current_test = (language, test_number)
+            open_test(language, test_number)
             st.rerun()
         except Exception as e:
             st.error(f"An error occurred while creating the test: {str(e)}")
             st.write("Please try again. If the problem persists, contact support.")
 
 # Function to generate flashcards
-def generate_flashcards(language, topics, api_key):
-    prompt = f"""
-    Create 5 flashcards for the following topics in {language}: {', '.join(topics)}. 
+@timed("flashcards")
+def generate_flashcards(language, topics, api_key, count=FLASHCARD_COUNT, index=None):
+    def build_prompt(topic, card_count):
+        return budget_prompt("flashcards", f"""
+    Create {card_count} flashcards for '{prompt_value(topic)}' in {prompt_value(language)}.
     Format each flashcard as:
 
     Front: [concept or question]
     Back: [explanation or answer]
 
     Ensure the flashcards cover key concepts and potential areas of confusion.
-    """
-    response = query_gemini_api(prompt, api_key)
-    return parse_flashcards(response)
+    """)
+    return run_generation(build_prompt, parse_flashcards, topics, count, api_key, index=index, operation="flashcards")
 
 def parse_flashcards(response):
-    flashcards = []
-    lines = response.strip().split('\n')
-    current_card = {}
-    for line in lines:
-        if line.startswith('Front:'):
-            if current_card:
-                flashcards.append(current_card)
-            current_card = {'front': line[6:].strip()}
-        elif line.startswith('Back:'):
-            current_card['back'] = line[5:].strip()
-    if current_card:
-        flashcards.append(current_card)
+    parser = FlashcardStreamParser()
+    flashcards = parser.parse(response)
+    get_parse_stats().record(parser)
     return flashcards
 
 # Login page
@@ -244,13 +3310,26 @@ def login_page():
     st.title("Login")
     username = st.text_input("Username", key="login_username")
     password = st.text_input("Password", type="password", key="login_password")
-    if st.button("Login", key="login_button"):
+    col1, col2 = st.columns(2)
+    with col1:
+        login_clicked = st.button("Login", key="login_button")
+    with col2:
+        register_clicked = st.button("Create Account", key="register_button")
+    if login_clicked:
         if authenticate(username, password):
             st.session_state.user_authenticated = True
+            st.session_state.username = username
             st.success("Logged in successfully!")
             st.rerun()
         else:
             st.error("Invalid credentials")
+    elif register_clicked:
+        if not username.strip() or not password:
+            st.error("Please enter a username and password.")
+        elif register_user(username.strip(), password):
+            st.success("Account created. You can now log in.")
+        else:
+            st.error("That username is already taken.")
 
 # Main application
 def main_app():
@@ -259,7 +3338,10 @@ def main_app():
     # Sidebar
     with st.sidebar:
         st.title("Menu")
-        menu = st.radio("Select:", ["Home", "Coding Courses", "Tests", "Flashcards"])
+        options = ["Home", "Coding Courses", "Tests", "Flashcards"]
+        if current_user() in ADMIN_USERS:
+            options.append("Admin")
+        menu = st.radio("Select:", options)
         
         if menu == "Coding Courses":
             st.subheader("Coding Courses")
@@ -276,8 +3358,8 @@ def main_app():
             for lang in st.session_state.conversations:
                 with st.expander(lang):
                     for test in st.session_state.tests.get(lang, []):
-                        if st.button(f"Test {test['number']}", key=f"test_{lang}_{test['number']}"):
-                            st.session_state.current_test = (lang, test['number'])
+                        if st.button(f"Test {test.number}", key=f"test_{lang}_{test.number}"):
+                            open_test(lang, test.number)
                             st.rerun()
                     if st.button("+ New Test", key=f"new_test_{lang}"):
                         st.session_state.new_test = lang
@@ -288,66 +3370,76 @@ def main_app():
             for lang in st.session_state.flashcards:
                 if st.button(f"{lang} Flashcards", key=f"flashcards_{lang}"):
                     st.session_state.current_flashcards = lang
+                    st.session_state.pop('revealed_card', None)
                     st.rerun()
     
-    # Main content area
+    # Main content area; current_view labels the render time of this run
+    st.session_state.current_view = menu.lower().replace(" ", "_")
     if menu == "Home":
         display_home()
     elif menu == "Coding Courses":
         if hasattr(st.session_state, 'new_course') and st.session_state.new_course:
+            st.session_state.current_view = "new_course"
             create_new_course()
         elif st.session_state.current_course:
+            st.session_state.current_view = "course"
             display_course_content(st.session_state.current_course)
     elif menu == "Tests":
-        if hasattr(st.session_state, 'new_test'):
+        if st.session_state.get('new_test'):
+            st.session_state.current_view = "new_test"
             create_new_test(st.session_state.new_test)
         elif hasattr(st.session_state, 'current_test'):
+            st.session_state.current_view = "test"
             display_test()
     elif menu == "Flashcards":
         if hasattr(st.session_state, 'current_flashcards'):
             display_flashcards()
+    elif menu == "Admin":
+        display_admin()
 
 def display_home():
     st.header("Welcome to Your Personalized Learning Platform")
     st.write("Here's an overview of your progress:")
     
-    for language, course_data in st.session_state.conversations.items():
-        progress = (course_data['current_day'] - 1) / course_data['max_day'] * 100
-        st.write(f"**{language}:** Day {course_data['current_day']} of {course_data['max_day']}")
-        st.progress(progress)
+    for language, course in st.session_state.conversations.items():
+        progress = (course.current_day - 1) / course.max_day * 100
+        st.write(f"**{language}:** Day {course.current_day} of {course.max_day}")
+        st.progress(min(int(progress), 100))
     
     st.write(f"Total Points: {st.session_state.user_points}")
 
+# Stored form of a course that starts today
+def new_course_data(study_plan, time_frame, level):
+    return {
+        "study_plan": study_plan,
+        "start_date": datetime.datetime.now().strftime("%Y-%m-%d"),
+        "current_day": 1,
+        "max_day": time_frame,
+        "level": level
+    }
+
 def create_new_course():
     st.subheader("Create New Course")
     
     if not st.session_state.gemini_api_key:
         st.session_state.gemini_api_key = st.text_input("Enter your Gemini API key:", type="password", key="api_key_input")
-        if st.session_state.gemini_api_key:
-            genai.configure(api_key=st.session_state.gemini_api_key)
-        else:
+        if not st.session_state.gemini_api_key:
             st.warning("Please enter your Gemini API key to continue.")
             return
     
-    all_languages = ["Python", "JavaScript", "Java", "C++", "C#", "Ruby", "Go", "Swift", "Kotlin", "PHP", "R", "TypeScript", "Scala", "Perl", "Rust", "Dart", "Haskell", "MATLAB"]
-    language = st.selectbox("Select a programming language:", [lang for lang in all_languages if lang not in st.session_state.conversations], key="new_course_language")
-    time_frame = st.number_input("Enter the course duration (days):", min_value=30, max_value=365, value=90, key="new_course_duration")
-    level = st.selectbox("Select your level of study:", ["Beginner", "Intermediate", "Advanced"], key="new_course_level")
+    language = st.selectbox("Select a programming language:", [lang for lang in COURSE_LANGUAGES if lang not in st.session_state.conversations], key="new_course_language")
+    time_frame = st.number_input("Enter the course duration (days):", min_value=COURSE_MIN_DAYS, max_value=COURSE_MAX_DAYS, value=90, key="new_course_duration")
+    level = st.selectbox("Select your level of study:", COURSE_LEVELS, key="new_course_level")
     
     if st.button("Generate Course", key="generate_course_button"):
         with st.spinner("Generating course content..."):
             try:
                 study_plan = generate_study_plan(language, time_frame, level, st.session_state.gemini_api_key)
                 if study_plan:
-                    session_data = {
-                        "study_plan": study_plan,
-                        "start_date": datetime.datetime.now().strftime("%Y-%m-%d"),
-                        "current_day": 1,
-                        "max_day": time_frame,
-                        "level": level
-                    }
-                    st.session_state.conversations[language] = session_data
+                    session_data = new_course_data(study_plan, time_frame, level)
                     save_session_data(language, session_data)
+                    st.session_state.conversations[language] = CourseState(
+                        session_data['start_date'], 1, time_frame, level, len(study_plan))
                     st.success(f"Course for {language} created successfully!")
                     st.session_state.new_course = False
                     st.session_state.current_course = language
@@ -355,51 +3447,111 @@ def create_new_course():
             except Exception as e:
                 st.error(f"An error occurred: {str(e)}")
     
+# Rerun only the calling fragment. Outside a fragment rerun (e.g. when the
+# fragment's widget fired during a full script run) Streamlit rejects the
+# fragment scope, so fall back to rerunning the whole app.
+def rerun_fragment():
+    try:
+        st.rerun(scope="fragment")
+    except StreamlitAPIException:
+        st.rerun()
+
 def display_course_content(language):
-    session_data = st.session_state.conversations[language]
-    study_plan = session_data['study_plan']
-    current_day = session_data['current_day']
-    max_day = session_data['max_day']
-    
     st.header(f"Course Content for {language}")
+    course_day_navigator(language)
+
+# Day view of a course. Runs as a fragment, so Previous/Next Day and explanations
+# only rerun this part of the page instead of the whole script.
+@st.fragment
+@timed_fragment
+def course_day_navigator(language):
+    course = get_course(language)
+    current_day = course.current_day
+    max_day = course.max_day
+    
     st.write(f"Current Progress: Day {current_day} of {max_day}")
     
-    if 0 <= current_day - 1 < len(study_plan):
-        topic = study_plan[current_day - 1]
+    if 0 <= current_day - 1 < course.plan_length:
+        topic = course_topic(language, current_day)
         st.subheader(f"Day {current_day}: {topic}")
+        prefetch_upcoming_explanations(language, course)
         
-        if st.button("Explain Today's Topic", key="explain_topic_button"):
-            with st.spinner("Generating explanation..."):
-                try:
-                    explanation = explain_topic(topic, language, st.session_state.gemini_api_key)
-                    if explanation:
-                        st.markdown(explanation)
-                except Exception as e:
-                    st.error(f"Error explaining topic: {str(e)}")
+        # The short summary is the default (and what gets prefetched); the
+        # in-depth explanation is only generated when asked for
+        summary_col, deep_col = st.columns(2)
+        with summary_col:
+            summary_clicked = st.button("Explain Today's Topic", key="explain_topic_button")
+        with deep_col:
+            deep_clicked = st.button("In-Depth Explanation", key="explain_topic_deep_button")
+        if summary_clicked or deep_clicked:
+            show_explanation(topic, language, course.level, "deep" if deep_clicked else "summary")
         
         col1, col2 = st.columns(2)
         with col1:
             if st.button("Previous Day", key="prev_day_button", disabled=current_day <= 1):
-                session_data['current_day'] -= 1
-                save_session_data(language, session_data)
-                st.rerun()
+                course.current_day -= 1
+                save_course_day(language, course.current_day)
+                rerun_fragment()
         with col2:
             if st.button("Next Day", key="next_day_button", disabled=current_day >= max_day):
-                session_data['current_day'] += 1
-                save_session_data(language, session_data)
-                st.rerun()
+                update_user_progress(language, current_day)
+                course.current_day += 1
+                save_course_day(language, course.current_day)
+                rerun_fragment()
     else:
         st.write("Course completed! You can review previous topics or start a new course.")
 
+# Stream an explanation into the page, falling back to a blocking request if the
+# stream breaks
+def show_explanation(topic, language, level, tier):
+    placeholder = st.empty()
+    try:
+        with st.spinner("Generating explanation..."):
+            stream = explain_topic_stream(topic, language, st.session_state.gemini_api_key, level, tier)
+            explanation = next(stream, "")
+        placeholder.markdown(explanation)
+        for chunk in stream:
+            explanation += chunk
+            placeholder.markdown(explanation)
+    except StreamInterruptedError:
+        with st.spinner("Connection interrupted, regenerating explanation..."):
+            try:
+                explanation = explain_topic(topic, language, st.session_state.gemini_api_key, level, tier=tier)
+                placeholder.markdown(explanation)
+            except Exception as e:
+                st.error(f"Error explaining topic: {str(e)}")
+    except Exception as e:
+        st.error(f"Error explaining topic: {str(e)}")
+
+def open_test(language, test_number):
+    st.session_state.current_test = (language, test_number)
+    st.session_state.current_question = 0
+    st.session_state.pop('answer_feedback', None)
+
 def display_test():
     language, test_number = st.session_state.current_test
-    test_data = next(test for test in st.session_state.tests[language] if test['number'] == test_number)
-    
     st.subheader(f"{language} - Test {test_number}")
+    test_question_view(language, test_number)
+
+# Question-by-question view of a test, rerun as a fragment on every answer
+@st.fragment
+@timed_fragment
+def test_question_view(language, test_number):
+    test_data = get_test(language, test_number)
     
     if 'current_question' not in st.session_state:
         st.session_state.current_question = 0
     
+    # Result of the previous answer, shown above the next question
+    feedback = st.session_state.pop('answer_feedback', None)
+    if feedback:
+        was_correct, correct_answer, explanation = feedback
+        if was_correct:
+            st.success("Correct!")
+        else:
+            st.error(f"Incorrect. The correct answer is: {correct_answer}")
+        st.write(f"Explanation: {explanation}")
+    
     if st.session_state.current_question < len(test_data['questions']):
         question = test_data['questions'][st.session_state.current_question]
         st.write(f"Question {st.session_state.current_question + 1}: {question['question']}")
@@ -410,87 +3562,211 @@ def display_test():
             test_data['user_answers'][st.session_state.current_question] = user_answer
             correct_answer = question['options'][ord(question['correct']) - ord('A')]
             if user_answer == correct_answer:
-                st.success("Correct!")
                 test_data['score'] += 1
-            else:
-                st.error(f"Incorrect. The correct answer is: {correct_answer}")
-            st.write(f"Explanation: {question['explanation']}")
-            
+            if question.get('topic'):
+                record_topic_answer(language, question['topic'], user_answer == correct_answer)
+            st.session_state.answer_feedback = (user_answer == correct_answer, correct_answer, question['explanation'])
+            save_test_answers(language, test_data)
             st.session_state.current_question += 1
-            if st.session_state.current_question < len(test_data['questions']):
-                st.rerun()
-            else:
-                st.success("Test completed!")
-                st.write(f"Your score: {test_data['score']}/{len(test_data['questions'])}")
-                
-                incorrect_topics = [q['question'].split()[0] for i, q in enumerate(test_data['questions']) 
-                                    if test_data['user_answers'].get(i) != question['options'][ord(question['correct']) - ord('A')]]
-                
-                if incorrect_topics:
-                    st.write("Topics to review:")
-                    st.write(", ".join(set(incorrect_topics)))
-                    
-                    if st.button("Generate Flashcards for Review", key="generate_flashcards"):
-                        generate_review_flashcards(language, list(set(incorrect_topics)))
-                
-                if st.button("Retake Test", key="retake_test"):
-                    test_data['user_answers'] = {}
-                    test_data['score'] = 0
-                    st.session_state.current_question = 0
-                    st.rerun()
+            rerun_fragment()
     else:
-        st.write("Test completed. You can retake the test or go back to the course content.")
+        st.success("Test completed!")
+        st.write(f"Your score: {test_data['score']}/{len(test_data['questions'])}")
+        
+        # Topics of the questions answered wrongly, in test order
+        incorrect_topics = list(dict.fromkeys(
+            q['topic'] for i, q in enumerate(test_data['questions'])
+            if q.get('topic') and test_data['user_answers'].get(i) != q['options'][ord(q['correct']) - ord('A')]))
+        
+        if incorrect_topics:
+            st.write("Topics to review:")
+            st.write(", ".join(incorrect_topics))
+            
+            if st.button("Generate Flashcards for Review", key="generate_flashcards"):
+                generate_review_flashcards(language, incorrect_topics)
+        
+        if st.button("Retake Test", key="retake_test"):
+            test_data['user_answers'] = {}
+            test_data['score'] = 0
+            save_test_answers(language, test_data)
+            st.session_state.current_question = 0
+            rerun_fragment()
 
 def generate_review_flashcards(language, topics):
     with st.spinner("Generating flashcards..."):
         try:
-            flashcards = generate_flashcards(language, topics, st.session_state.gemini_api_key)
-            if language not in st.session_state.flashcards:
-                st.session_state.flashcards[language] = []
-            st.session_state.flashcards[language].extend(flashcards)
+            index = get_flashcard_index(current_user(), language)
+            mastery = get_mastery(language)
+            counts = weighted_split(FLASHCARD_COUNT, {topic: 1 - topic_accuracy(mastery.get(topic, (0, 0))) for topic in topics})
+            flashcards = generate_flashcards(language, topics, st.session_state.gemini_api_key, counts, index)
+            flashcards = [card for card in flashcards if index.add(card['front'])]
+            if not flashcards:
+                st.info("Your deck already has flashcards for these topics.")
+                return
+            due = int(time.time())
+            for card in flashcards:
+                card.update(ease=FLASHCARD_INITIAL_EASE, interval=0, reps=0, due=due)
+            # Read the deck's window before inserting, so the new cards aren't read twice
+            queue = get_due_queue(language)
+            card_ids = get_storage().add_flashcards(current_user(), language, flashcards)
+            for card, card_id in zip(flashcards, card_ids):
+                card['id'] = card_id
+                queue.push(card)
+            st.session_state.flashcards[language] = None
             st.success("Flashcards generated successfully!")
             st.session_state.current_flashcards = language
             st.rerun()
         except Exception as e:
             st.error(f"An error occurred: {str(e)}")
 
+# SM-2: update a card's ease, interval (days), repetition count and due time after
+# a review graded from 0 (blackout) to 5 (perfect recall)
+def schedule_review(card, quality, now=None):
+    now = time.time() if now is None else now
+    if quality < 3:
+        card['reps'] = 0
+        card['interval'] = 0
+        card['due'] = int(now + FLASHCARD_RELEARN_SECONDS)
+    else:
+        card['reps'] += 1
+        if card['reps'] == 1:
+            card['interval'] = 1
+        elif card['reps'] == 2:
+            card['interval'] = 6
+        else:
+            card['interval'] = round(card['interval'] * card['ease'], 2)
+        card['due'] = int(now + card['interval'] * 86400)
+    card['ease'] = max(FLASHCARD_MIN_EASE, card['ease'] + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02))
+    return card
+
+# The earliest-due cards of a deck, read from storage a window at a time.
+# Only the schedules of at most window cards are held, in a min-heap by
+# (due, id); a card's text is read when it reaches the top. The window holds
+# every card of the deck up to its boundary, the last (due, id) read, so a
+# review that moves a card past the boundary just drops it, and it is read
+# again with the next window. Rescheduling pushes a new heap entry and leaves
+# the old one behind; stale entries are dropped when they reach the top.
+class DueQueue:
+    def __init__(self, load_window, load_text, window=FLASHCARD_DUE_WINDOW):
+        self._load_window = load_window  # limit -> schedules ordered by (due, id)
+        self._load_text = load_text  # card id -> (front, back)
+        self.window = window
+        self._schedules = {}  # card id -> schedule of a card in the window
+        self._heap = []  # (due, card id)
+        self._boundary = None  # None once the window holds the whole deck
+        self._top = None  # the card peek returned last, with its text
+        self._refill()
+
+    def _refill(self):
+        cards = self._load_window(self.window)
+        self._schedules = {card['id']: card for card in cards}
+        self._heap = [(card['due'], card['id']) for card in cards]
+        heapq.heapify(self._heap)
+        self._boundary = (cards[-1]['due'], cards[-1]['id']) if len(cards) >= self.window else None
+
+    def _stale(self, entry):
+        schedule = self._schedules.get(entry[1])
+        return schedule is None or schedule['due'] != entry[0]
+
+    # Add a new or rescheduled card
+    def push(self, card):
+        schedule = {key: card[key] for key in ('id', 'ease', 'interval', 'reps', 'due')}
+        if self._boundary is not None and (schedule['due'], schedule['id']) > self._boundary:
+            self._schedules.pop(schedule['id'], None)
+            return
+        self._schedules[schedule['id']] = schedule
+        heapq.heappush(self._heap, (schedule['due'], schedule['id']))
+        # Rebuild once stale entries outnumber live ones
+        if len(self._heap) > 2 * len(self._schedules) + 64:
+            self._heap = [entry for entry in self._heap if not self._stale(entry)]
+            heapq.heapify(self._heap)
+
+    # Card with the earliest due time, or None if the deck is empty
+    def peek(self):
+        while True:
+            while self._heap and self._stale(self._heap[0]):
+                heapq.heappop(self._heap)
+            if self._heap or self._boundary is None:
+                break
+            self._refill()
+        if not self._heap:
+            return None
+        due, card_id = self._heap[0]
+        if self._top is None or self._top['id'] != card_id or self._top['due'] != due:
+            front, back = self._load_text(card_id)
+            self._top = {**self._schedules[card_id], 'front': front, 'back': back}
+        return self._top
+
+    def next_due(self, now):
+        card = self.peek()
+        return card if card is not None and card['due'] <= now else None
+
+# Only one deck's window is held per session; opening another drops the previous one
+def get_due_queue(language):
+    if language not in st.session_state.due_queues:
+        storage = get_storage()
+        user = current_user()
+        def load_window(limit):
+            flush_writes()  # buffered reviews move cards
+            return storage.load_due_flashcards(user, language, limit)
+        st.session_state.due_queues.clear()
+        st.session_state.due_queues[language] = DueQueue(load_window, storage.load_flashcard_text)
+    return st.session_state.due_queues[language]
+
+def review_flashcard(language, card, quality):
+    schedule_review(card, quality)
+    get_due_queue(language).push(card)
+    get_write_behind().review_card(card)
+    st.session_state.pop('revealed_card', None)
+
+def describe_wait(seconds):
+    if seconds < 3600:
+        return f"{max(1, round(seconds / 60))} minutes"
+    if seconds < 86400:
+        return f"{round(seconds / 3600)} hours"
+    return f"{round(seconds / 86400)} days"
+
 def display_flashcards():
     language = st.session_state.current_flashcards
-    flashcards = st.session_state.flashcards[language]
-    
     st.subheader(f"Flashcards for {language}")
+    flashcard_viewer(language)
+
+# Review session over the cards that are due, rerun as a fragment on every reveal
+# and grade
+@st.fragment
+@timed_fragment
+def flashcard_viewer(language):
+    queue = get_due_queue(language)
+    if queue.peek() is None:
+        st.write("No flashcards available for this language.")
+        return
     
-    if 'current_card' not in st.session_state:
-        st.session_state.current_card = 0
+    now = time.time()
+    card = queue.next_due(now)
+    if card is None:
+        st.write(f"No cards due for review. The next card is due in {describe_wait(queue.peek()['due'] - now)}.")
+        return
     
-    if flashcards:
-        card = flashcards[st.session_state.current_card]
-        
-        col1, col2 = st.columns(2)
-        with col1:
-            st.write("Front:")
-            st.write(card['front'])
-        with col2:
-            if st.button("Reveal Answer", key="reveal_answer"):
-                st.write("Back:")
-                st.write(card['back'])
-        
-        col1, col2, col3 = st.columns(3)
-        with col1:
-            if st.button("Previous Card", key="prev_card", disabled=st.session_state.current_card <= 0):
-                st.session_state.current_card -= 1
-                st.rerun()
-        with col2:
-            if st.button("Next Card", key="next_card", disabled=st.session_state.current_card >= len(flashcards) - 1):
-                st.session_state.current_card += 1
-                st.rerun()
-        with col3:
-            if st.button("Shuffle", key="shuffle_cards"):
-                random.shuffle(flashcards)
-                st.session_state.current_card = 0
-                st.rerun()
-    else:
-        st.write("No flashcards available for this language.")
+    revealed = st.session_state.get('revealed_card') == card['id']
+    col1, col2 = st.columns(2)
+    with col1:
+        st.write("Front:")
+        st.write(card['front'])
+    with col2:
+        if revealed:
+            st.write("Back:")
+            st.write(card['back'])
+        elif st.button("Reveal Answer", key="reveal_answer"):
+            st.session_state.revealed_card = card['id']
+            rerun_fragment()
+    
+    if revealed:
+        st.write("How well did you remember it?")
+        for column, (label, quality) in zip(st.columns(len(FLASHCARD_GRADES)), FLASHCARD_GRADES):
+            with column:
+                if st.button(label, key=f"grade_{quality}"):
+                    review_flashcard(language, card, quality)
+                    rerun_fragment()
 
 # User progress tracking
 def update_user_progress(language, day_completed):
@@ -499,23 +3775,20 @@ def update_user_progress(language, day_completed):
     if language not in st.session_state.progress:
         st.session_state.progress[language] = set()
     st.session_state.progress[language].add(day_completed)
-    save_progress(language)
+    get_write_behind().add_progress_day(current_user(), language, day_completed)
 
 def save_progress(language):
-    progress_file = f"{language}_progress.json"
-    with open(progress_file, 'w') as f:
-        json.dump(list(st.session_state.progress[language]), f)
+    flush_writes()
+    get_storage().save_progress(current_user(), language, st.session_state.progress[language])
 
 def load_progress(language):
-    progress_file = f"{language}_progress.json"
-    if os.path.exists(progress_file):
-        with open(progress_file, 'r') as f:
-            return set(json.load(f))
-    return set()
+    flush_writes()
+    return get_storage().load_progress(current_user(), language)
 
 # Gamification elements
 def award_points(points):
     st.session_state.user_points += points
+    get_write_behind().add_points(current_user(), points)
     st.success(f"You earned {points} points!")
 
 def display_achievements():
@@ -532,16 +3805,73 @@ def display_achievements():
         if st.session_state.user_points >= points:
             st.sidebar.write(f"🏆 {title}: {description}")
 
+# Metrics overview for operators: latency percentiles, counters and the state of
+# the shared caches and queues
+def display_admin():
+    st.header("Admin")
+    metrics = get_metrics()
+    st.subheader("Latency (seconds)")
+    latency = metrics.histogram_rows("_seconds")
+    if latency:
+        st.dataframe(latency)
+    else:
+        st.write("No timings recorded yet.")
+    st.subheader("Sizes and attempts")
+    sizes = [row for row in metrics.histogram_rows() if not row["metric"].endswith("_seconds")]
+    if sizes:
+        st.dataframe(sizes)
+    st.subheader("Counters")
+    counters = metrics.counter_rows()
+    if counters:
+        st.dataframe(counters)
+
+    st.subheader("Internals")
+    scheduler = get_gemini_scheduler()
+    parse_stats = get_parse_stats()
+    st.json({
+        "gemini_scheduler": {
+            "queue_depth": scheduler.queue_depth(),
+            "submitted": scheduler.submitted,
+            "coalesced": scheduler.coalesced,
+            "retried": scheduler.retried,
+            "hedged": scheduler.hedged,
+            "hedges_won": scheduler.hedges_won,
+            "circuits": scheduler.circuit_states(),
+            "completed": scheduler.completed,
+            "failed": scheduler.failed,
+        },
+        "explanation_cache": get_explanation_cache().stats(),
+        "pending_writes": get_write_behind().pending_count(),
+        "fingerprint_indexes": get_fingerprint_indexes().stats(),
+        "topic_indexes": get_topic_indexes().stats(),
+        "parse_failure_rate": {kind: parse_stats.failure_rate(kind) for kind in ("test_questions", "flashcards")},
+    })
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("Download Prometheus text", metrics.prometheus_text(), file_name="metrics.prom",
+                           mime="text/plain", key="download_metrics_prom")
+    with col2:
+        st.download_button("Download JSON lines", metrics.json_lines(), file_name="metrics.jsonl",
+                           mime="application/x-ndjson", key="download_metrics_jsonl")
+
 # Main execution
 if __name__ == "__main__":
-    if not st.session_state.user_authenticated:
-        login_page()
-    else:
-        main_app()
-        display_achievements()
+    render_started = time.perf_counter()
+    try:
+        initialize_session_state()
+        if not st.session_state.user_authenticated:
+            login_page()
+        else:
+            main_app()
+            display_achievements()
+    finally:
+        view = st.session_state.get("current_view", "home") if st.session_state.get("user_authenticated") else "login"
+        get_metrics().observe("render_seconds", time.perf_counter() - render_started, view=view)
 
 # Logout functionality
 if st.sidebar.button("Logout", key="logout"):
+    flush_writes()
     for key in list(st.session_state.keys()):
         del st.session_state[key]
     st.rerun()
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Offline backend with a short latency; set before the app module reads them
+os.environ.setdefault("LLM_BACKEND", "fake")
+os.environ.setdefault("FAKE_LLM_LATENCY", "0.05")
+os.environ.setdefault("PREFETCH_AHEAD_DAYS", "0")
+os.environ.setdefault("STORAGE_PATH", os.path.join(tempfile.mkdtemp(), "learning_platform.db"))
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
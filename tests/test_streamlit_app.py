@@ -0,0 +1,376 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import streamlit_app as app
+
+
+def fail_with(kind):
+    def fn(timeout):
+        raise app.LLMError(f"{kind} failure", kind)
+    return fn
+
+
+@pytest.fixture
+def scheduler():
+    return app.GeminiScheduler(max_concurrency=4, rate_per_minute=60_000, burst=100, metrics=app.Metrics())
+
+
+@pytest.fixture
+def storage(tmp_path):
+    return app.SQLiteStorage(str(tmp_path / "learning_platform.db"))
+
+
+# Scheduler
+
+def test_interactive_request_overtakes_queued_prefetches(monkeypatch):
+    scheduler = app.GeminiScheduler(max_concurrency=4, rate_per_minute=600, burst=1, metrics=app.Metrics())
+    order = []
+    def job(name):
+        def fn(timeout):
+            order.append(name)
+            return name
+        return fn
+    futures = [scheduler.submit(job(f"prefetch{i}"), "key", app.PRIORITY_PREFETCH) for i in range(3)]
+    time.sleep(0.02)
+    futures.append(scheduler.submit(job("interactive"), "key", app.PRIORITY_INTERACTIVE))
+    for future in futures:
+        future.result(timeout=5)
+    assert order == ["prefetch0", "interactive", "prefetch1", "prefetch2"]
+    assert scheduler.queue_depth() == 0
+
+
+def test_identical_requests_share_one_call(scheduler):
+    calls = []
+    release = threading.Event()
+    def fn(timeout):
+        calls.append(timeout)
+        release.wait(5)
+        return "answer"
+    first = scheduler.submit(fn, "key", coalesce_key="prompt")
+    second = scheduler.submit(fn, "key", coalesce_key="prompt")
+    release.set()
+    assert first is second
+    assert first.result(timeout=5) == "answer"
+    assert len(calls) == 1
+    assert scheduler.coalesced == 1
+
+
+def test_transient_errors_are_retried_and_safety_blocks_are_not(scheduler, monkeypatch):
+    monkeypatch.setitem(app.GEMINI_RETRY_POLICIES, "transient", {"retry": True, "backoff": 0.01})
+    attempts = []
+    def flaky(timeout):
+        attempts.append(timeout)
+        if len(attempts) < 3:
+            raise RuntimeError("connection reset")
+        return "ok"
+    assert scheduler.submit(flaky, "key", max_retries=3).result(timeout=5) == "ok"
+    assert len(attempts) == 3
+
+    with pytest.raises(ValueError) as error:
+        scheduler.submit(fail_with("safety"), "other-key").result(timeout=5)
+    assert error.value.kind == "safety"
+    assert scheduler.retried == 2
+
+
+def test_request_waiting_for_a_token_fails_at_its_deadline():
+    scheduler = app.GeminiScheduler(max_concurrency=2, rate_per_minute=6, burst=1, metrics=app.Metrics())
+    scheduler.submit(lambda timeout: "first", "key").result(timeout=5)
+    started = time.monotonic()
+    with pytest.raises(ValueError) as error:
+        scheduler.submit(lambda timeout: "second", "key", deadline=0.3).result(timeout=5)
+    assert error.value.kind == "timeout"
+    assert time.monotonic() - started < 1
+    assert scheduler.queue_depth() == 0
+
+
+def test_cancelled_requests_do_not_stall_their_key():
+    scheduler = app.GeminiScheduler(max_concurrency=2, rate_per_minute=600, burst=1, metrics=app.Metrics())
+    futures = [scheduler.submit(lambda timeout, i=i: i, "key") for i in range(4)]
+    futures[1].cancel()
+    assert [futures[i].result(timeout=5) for i in (0, 2, 3)] == [0, 2, 3]
+    assert scheduler.queue_depth() == 0
+
+
+def test_circuit_opens_after_repeated_failures_and_closes_after_a_good_probe(scheduler, monkeypatch):
+    monkeypatch.setitem(app.GEMINI_RETRY_POLICIES, "transient", {"retry": True, "backoff": 0.01})
+    scheduler._breaker("key").cooldown = 0.2
+    for _ in range(app.CIRCUIT_BREAKER_FAILURES):
+        with pytest.raises(ValueError):
+            scheduler.submit(fail_with("transient"), "key", max_retries=1).result(timeout=5)
+    assert scheduler.circuit_states()["open"] == 1
+    with pytest.raises(ValueError) as error:
+        scheduler.submit(lambda timeout: "x", "key").result(timeout=5)
+    assert error.value.kind == "circuit_open"
+
+    time.sleep(0.25)
+    release = threading.Event()
+    def probe(timeout):
+        release.wait(5)
+        return "probe"
+    probe_future = scheduler.submit(probe, "key")
+    time.sleep(0.05)
+    waiting = scheduler.submit(lambda timeout: "after", "key")
+    time.sleep(0.1)
+    assert not waiting.done()
+    release.set()
+    assert probe_future.result(timeout=5) == "probe"
+    assert waiting.result(timeout=5) == "after"
+    assert scheduler.circuit_states()["closed"] == 1
+
+
+def test_probe_blocked_by_safety_closes_the_circuit(scheduler, monkeypatch):
+    monkeypatch.setitem(app.GEMINI_RETRY_POLICIES, "transient", {"retry": True, "backoff": 0.01})
+    scheduler._breaker("key").cooldown = 0.1
+    for _ in range(app.CIRCUIT_BREAKER_FAILURES):
+        with pytest.raises(ValueError):
+            scheduler.submit(fail_with("transient"), "key", max_retries=1).result(timeout=5)
+    time.sleep(0.15)
+    with pytest.raises(ValueError):
+        scheduler.submit(fail_with("safety"), "key").result(timeout=5)
+    assert scheduler.submit(lambda timeout: "ok", "key").result(timeout=2) == "ok"
+
+
+def test_winning_hedge_is_recorded_once_with_the_latency_the_caller_saw(scheduler, monkeypatch):
+    monkeypatch.setattr(app, "GEMINI_HEDGE_DEFAULT_DELAY", 0.05)
+    calls = []
+    discarded = []
+    def fn(timeout):
+        calls.append(timeout)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return "slow"
+        return "fast"
+    started = time.monotonic()
+    result = scheduler.submit(fn, "key", hedge=True, discard=discarded.append).result(timeout=5)
+    assert result == "fast"
+    assert time.monotonic() - started < 0.4
+    time.sleep(0.6)
+    assert discarded == ["slow"]
+    assert scheduler.completed == 1 and scheduler.failed == 0 and scheduler.hedges_won == 1
+    text = scheduler.metrics.prometheus_text()
+    assert 'gemini_requests_total{operation="other",outcome="ok"} 1' in text
+    assert 'outcome="error"' not in text.split("gemini_requests_total", 1)[1].split("# TYPE", 1)[0]
+    assert scheduler.metrics.percentile("gemini_call_seconds", 0.99, operation="other", outcome="ok") < 0.4
+
+
+def test_concurrent_identical_streams_share_one_upstream_call():
+    backend = app.get_llm_backend()
+    calls = backend.calls
+    prompt = "Explain 'Shared Streams' in Python"
+    texts = []
+    def read():
+        texts.append("".join(app.query_gemini_api_stream(prompt, "key")))
+    threads = [threading.Thread(target=read) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert backend.calls - calls == 1
+    assert len(texts) == 3 and len(set(texts)) == 1 and texts[0]
+
+
+# Streaming parsers
+
+QUESTIONS = """Sure! Here are your questions:
+
+Q: What does `7 // 2` evaluate to?
+A) 3.5
+B) 3
+C) 4
+D) 1
+Correct: B
+Explanation: Floor division drops the remainder.
+
+**Question 2:** What does this loop print?
+```python
+for i in range(3):
+    print(i)
+```
+A) 0 1 2
+B) 1 2 3
+C) 0 1 2 3
+D) Nothing
+**Correct:** A
+Explanation: range(3) yields 0, 1 and 2.
+
+Q: A question without options
+Correct: A
+Explanation: Dropped.
+"""
+
+
+def test_question_parser_yields_the_same_items_for_any_chunking():
+    whole = app.QuestionStreamParser().parse(QUESTIONS)
+    rng = random.Random(0)
+    for _ in range(20):
+        parser = app.QuestionStreamParser()
+        items, position = [], 0
+        while position < len(QUESTIONS):
+            size = rng.randint(1, 40)
+            items.extend(parser.feed(QUESTIONS[position:position + size]))
+            position += size
+        items.extend(parser.close())
+        assert items == whole
+    assert [item["correct"] for item in whole] == ["B", "A"]
+    assert whole[0]["question"] == "What does `7 // 2` evaluate to?"
+    assert whole[1]["question"].endswith("for i in range(3):\n    print(i)\n```")
+
+
+def test_question_parser_reports_dropped_items():
+    parser = app.QuestionStreamParser()
+    parser.parse(QUESTIONS)
+    assert (parser.accepted, parser.rejected) == (2, 1)
+    assert [d.code for d in parser.diagnostics if d.severity == "error"] == ["missing_options"]
+
+
+def test_question_parser_yields_items_before_the_stream_ends():
+    parser = app.QuestionStreamParser()
+    first_question = QUESTIONS.split("**Question 2:**")[0]
+    assert len(list(parser.feed(first_question))) == 1
+
+
+def test_flashcard_parser_keeps_multiline_backs_and_drops_cards_without_one():
+    cards = app.FlashcardStreamParser().parse(
+        "Front: What is a list?\nBack: An ordered,\nmutable sequence.\n\n1. **Front:** A lonely front\n")
+    assert cards == [{"front": "What is a list?", "back": "An ordered,\nmutable sequence."}]
+
+
+# Write-behind buffer
+
+def make_buffer(storage, tmp_path):
+    return app.WriteBehindBuffer(storage, str(tmp_path / "journal"), interval=3600)
+
+
+def test_buffered_writes_are_merged_and_applied_on_flush(storage, tmp_path):
+    buffer = make_buffer(storage, tmp_path)
+    buffer.add_points("u", 10)
+    buffer.add_points("u", 5)
+    buffer.record_answer("u", "Python", "Loops", True)
+    buffer.record_answer("u", "Python", "Loops", False)
+    assert storage.load_points("u") == 0
+    assert buffer.flush() == 2
+    assert storage.load_points("u") == 15
+    assert storage.load_topic_mastery("u", "Python") == {"Loops": (1, 2)}
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("journal")]
+
+
+def test_journal_left_by_a_crashed_process_is_replayed_once(storage, tmp_path):
+    ops = [{"op": "points", "user": "u", "points": 7}]
+    with open(tmp_path / "journal-99999", "w", encoding="utf-8") as f:
+        json.dump({"id": "crashed-batch", "ops": ops}, f)
+    (tmp_path / "journal-99998.tmp").write_text("{never renamed")
+    buffer = make_buffer(storage, tmp_path)
+    assert buffer.replayed == 1
+    assert storage.load_points("u") == 7
+    assert not storage.apply_write_batch("crashed-batch", ops)
+    assert storage.load_points("u") == 7
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("journal")]
+
+
+def test_failed_flush_replayed_by_another_process_is_not_applied_twice(storage, tmp_path, monkeypatch):
+    buffer = make_buffer(storage, tmp_path)
+    apply = storage.apply_write_batch
+    failures = [sqlite3.OperationalError("database is locked")]
+    def flaky_apply(batch_id, ops):
+        if failures:
+            raise failures.pop()
+        return apply(batch_id, ops)
+    monkeypatch.setattr(storage, "apply_write_batch", flaky_apply)
+    buffer.add_points("u", 10)
+    with pytest.raises(sqlite3.OperationalError):
+        buffer.flush()
+    assert buffer.pending_count() == 1
+    other = make_buffer(app.SQLiteStorage(storage.path), tmp_path)
+    assert other.replayed == 1
+    buffer.add_points("u", 5)
+    buffer.flush()
+    assert storage.load_points("u") == 15
+    assert buffer.pending_count() == 0
+
+
+# Duplicate detection
+
+def question(stem, options=("1", "3", "3.5", "49")):
+    return {"question": stem, "options": list(options)}
+
+
+def test_question_fingerprint_keeps_operators_and_options():
+    stems = [f"What is the result of 7 {op} 2?" for op in ("//", "/", "%", "**")]
+    fingerprints = {app.text_fingerprint(app.question_text(question(stem))) for stem in stems}
+    assert len(fingerprints) == 4
+    base = question(stems[0])
+    assert app.text_fingerprint(app.question_text(base)) != app.text_fingerprint(
+        app.question_text(question(stems[0], ("0", "2", "4", "6"))))
+    assert app.text_fingerprint(app.question_text(base)) == app.text_fingerprint(
+        app.question_text(question("what  is the RESULT of 7 // 2?")))
+
+
+def test_bank_keeps_questions_that_differ_only_by_operator(storage):
+    questions = [question(f"What is the result of 7 {op} 2?") for op in ("//", "/", "%", "**")]
+    assert storage.add_bank_questions("Python", "Beginner", "Operators", questions) == 4
+    assert storage.add_bank_questions("Python", "Beginner", "Operators", questions[:1]) == 0
+
+
+def test_question_index_only_rejects_near_duplicates_within_a_topic():
+    index = app.FingerprintIndex(threshold=app.QUESTION_NEAR_DUPLICATE_THRESHOLD, by_group=True)
+    keywords = ("def", "class", "func", "lambda")
+    function = app.question_text(question("Which keyword is used to define a function in Python?", keywords))
+    klass = app.question_text(question("Which keyword is used to define a class in Python?", keywords))
+    assert index.add(function, "Functions")
+    assert index.find_duplicate(klass, "Functions") is None
+    assert index.find_duplicate(function, "Classes") == "exact"
+    reworded = function.replace("Python?", "Python.")
+    assert index.find_duplicate(reworded, "Classes") is None
+    assert index.find_duplicate(reworded, "Functions") == "near"
+
+
+# Spaced repetition
+
+def test_sm2_schedule():
+    card = {"ease": 2.5, "interval": 0, "reps": 0, "due": 0}
+    app.schedule_review(card, 4, now=0)
+    assert (card["reps"], card["interval"], card["due"]) == (1, 1, 86400)
+    app.schedule_review(card, 4, now=0)
+    assert card["interval"] == 6
+    app.schedule_review(card, 5, now=0)
+    assert card["interval"] == round(6 * 2.5, 2)
+    app.schedule_review(card, 1, now=100)
+    assert (card["reps"], card["interval"], card["due"]) == (0, 0, 100 + app.FLASHCARD_RELEARN_SECONDS)
+    assert card["ease"] >= app.FLASHCARD_MIN_EASE
+
+
+def test_due_queue_serves_cards_in_due_order_through_small_windows(storage):
+    rng = random.Random(1)
+    now = int(time.time())
+    storage.add_flashcards("u", "Python", [{"front": f"Front {i}", "back": f"Back {i}", "due": now + rng.randint(-600, 600)}
+                                           for i in range(300)])
+    unflushed = []
+    def load_window(limit):
+        for card in unflushed:
+            storage.update_flashcard_schedule(card["id"], card["ease"], card["interval"], card["reps"], card["due"])
+        unflushed.clear()
+        return storage.load_due_flashcards("u", "Python", limit)
+    queue = app.DueQueue(load_window, storage.load_flashcard_text, window=20)
+    truth = {card["id"]: card for card in storage.load_due_flashcards("u", "Python", 1000)}
+    for _ in range(1000):
+        card = queue.peek()
+        expected = min(truth.values(), key=lambda c: (c["due"], c["id"]))
+        assert card["id"] == expected["id"]
+        assert (card["front"], card["back"]) == storage.load_flashcard_text(card["id"])
+        app.schedule_review(card, rng.choice([1, 3, 4, 5]), now=card["due"])
+        truth[card["id"]] = {key: card[key] for key in ("id", "ease", "interval", "reps", "due")}
+        unflushed.append(dict(card))
+        queue.push(card)
+        assert len(queue._schedules) <= 20
+
+
+def test_due_queue_of_an_empty_deck(storage):
+    queue = app.DueQueue(lambda limit: storage.load_due_flashcards("u", "Python", limit), storage.load_flashcard_text)
+    assert queue.peek() is None
+    assert queue.next_due(time.time()) is None